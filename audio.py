@@ -0,0 +1,146 @@
+"""System volume backends for the volume slider.
+
+Every backend reads and sets the master volume of the default output as
+a float from 0.0 to 1.0. Backends are opened, used and closed on one
+thread (the server's VolumeService worker), which Windows COM requires.
+
+Pick one with ``AUDIO_BACKEND``:
+
+- ``auto``   the first of pycaw, pulse that works on this host (default)
+- ``pycaw``  Windows Core Audio (needs ``pycaw`` and ``comtypes``)
+- ``pulse``  PulseAudio or PipeWire through ``pactl`` or ``wpctl``
+- ``mock``   an in-memory level, no audio device needed
+- ``none``   volume control disabled
+"""
+import re
+import shutil
+import subprocess
+
+try:
+    import comtypes
+    from comtypes import CLSCTX_ALL
+    from ctypes import cast, POINTER
+    from pycaw.pycaw import AudioUtilities, IAudioEndpointVolume
+except ImportError:
+    AudioUtilities = None
+
+
+class AudioBackend:
+    """Base class: ``open()`` raises if the backend can't work here."""
+
+    name = 'base'
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def get(self):
+        raise NotImplementedError
+
+    def set(self, level):
+        raise NotImplementedError
+
+
+class PycawAudio(AudioBackend):
+    name = 'pycaw'
+
+    def __init__(self):
+        self.endpoint = None
+
+    def open(self):
+        if AudioUtilities is None:
+            raise RuntimeError("Windows volume control needs pycaw: pip install pycaw")
+        comtypes.CoInitialize()
+        devices = AudioUtilities.GetSpeakers()
+        interface = devices.Activate(IAudioEndpointVolume._iid_, CLSCTX_ALL, None)
+        self.endpoint = cast(interface, POINTER(IAudioEndpointVolume))
+
+    def close(self):
+        if self.endpoint is not None:
+            self.endpoint = None
+            comtypes.CoUninitialize()
+
+    def get(self):
+        return self.endpoint.GetMasterVolumeLevelScalar()
+
+    def set(self, level):
+        self.endpoint.SetMasterVolumeLevelScalar(level, None)
+
+
+class PulseAudio(AudioBackend):
+    """The default sink through ``pactl`` (PulseAudio, pipewire-pulse) or ``wpctl`` (PipeWire)."""
+
+    name = 'pulse'
+    TIMEOUT = 2.0
+
+    def __init__(self):
+        self.tool = None
+
+    def open(self):
+        self.tool = shutil.which('pactl') or shutil.which('wpctl')
+        if self.tool is None:
+            raise RuntimeError("PulseAudio/PipeWire volume control needs pactl or wpctl")
+        self.get()
+
+    def _run(self, *args):
+        return subprocess.run([self.tool, *args], capture_output=True, text=True,
+                              timeout=self.TIMEOUT, check=True).stdout
+
+    def _wpctl(self):
+        return self.tool.endswith('wpctl')
+
+    def get(self):
+        if self._wpctl():
+            # "Volume: 0.45" (plus " [MUTED]")
+            return float(self._run('get-volume', '@DEFAULT_AUDIO_SINK@').split()[1])
+        # "Volume: front-left: 29491 /  45% / -20.81 dB,   front-right: ..."
+        percents = re.findall(r'(\d+)%', self._run('get-sink-volume', '@DEFAULT_SINK@'))
+        return int(percents[0]) / 100
+
+    def set(self, level):
+        if self._wpctl():
+            self._run('set-volume', '@DEFAULT_AUDIO_SINK@', f'{level:.2f}')
+        else:
+            self._run('set-sink-volume', '@DEFAULT_SINK@', f'{round(level * 100)}%')
+
+
+class MockAudio(AudioBackend):
+    """Keeps the level in memory, for running the server without a sound system."""
+
+    name = 'mock'
+
+    def __init__(self, level=0.5):
+        self.level = level
+
+    def get(self):
+        return self.level
+
+    def set(self, level):
+        self.level = level
+
+
+BACKENDS = {
+    'pycaw': PycawAudio,
+    'pulse': PulseAudio,
+    'mock': MockAudio,
+}
+
+
+def open_backend(spec):
+    """Open the backend an ``AUDIO_BACKEND`` value names; None if none works."""
+    if spec == 'none':
+        return None
+    if spec != 'auto' and spec not in BACKENDS:
+        raise ValueError(f"Unknown audio backend {spec!r} (choose from auto, {', '.join(BACKENDS)}, none)")
+    for name in (['pycaw', 'pulse'] if spec == 'auto' else [spec]):
+        backend = BACKENDS[name]()
+        try:
+            backend.open()
+        except Exception as e:
+            if spec != 'auto':
+                print(f"⚠️  Audio backend {name} unavailable: {e}")
+            continue
+        return backend
+    return None
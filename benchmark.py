@@ -0,0 +1,251 @@
+"""Offline benchmark for the capture -> render -> encode frame pipeline.
+
+Runs the same zoom/crop/resize/cursor-overlay/JPEG code the server uses
+(frame_pipeline.py) on synthetic or recorded frames, so it needs no
+display, mouse or audio. Every combination of resolution, zoom and JPEG
+quality is timed and the results can be saved as JSON and compared with
+an earlier run:
+
+    python benchmark.py --output base.json
+    python benchmark.py --compare base.json --fail-over 10
+
+``--workers 1,2,4`` also runs every case through an EncodePool of that
+many processes; there fps is wall-clock throughput and the latencies
+run from submit to in-order result. ``--captures full,region`` compares
+cropping a full grab with grabbing only the zoomed region, as the
+server does.
+"""
+import argparse
+import itertools
+import json
+import math
+import platform
+import sys
+import time
+
+import cv2
+import numpy as np
+
+import capture
+import frame_pipeline
+
+
+def parse_list(value, cast):
+    return [cast(v) for v in value.split(',') if v]
+
+
+def parse_resolution(value):
+    width, _, height = value.lower().partition('x')
+    return int(width), int(height)
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def cursor_path(i, width, height):
+    """A deterministic sweep over the screen so zoom crops move around."""
+    t = i / 30.0
+    return (int((0.5 + 0.45 * math.sin(t)) * (width - 1)),
+            int((0.5 + 0.45 * math.sin(t * 1.7 + 1)) * (height - 1)))
+
+
+def make_backend(spec, width, height, change_every):
+    if spec == 'synthetic':
+        return capture.SyntheticCapture(width, height, change_every)
+    backend = capture.open_backend(spec)
+    if not isinstance(backend, capture.ReplayCapture):
+        raise SystemExit(f"Only offline backends can be benchmarked, not {spec!r}")
+    return backend
+
+
+def grab_view(backend, monitor, pos, zoom, mode, out=None):
+    """Grab for one frame; returns ``(raw, pos, screen_size, zoom)`` to render it with."""
+    if mode != 'region' or zoom <= 1.0:
+        return backend.grab(monitor, out=out), pos, (monitor['width'], monitor['height']), zoom
+    region = frame_pipeline.zoom_region(monitor, pos, zoom)
+    pos = (pos[0] - region['left'] + monitor['left'], pos[1] - region['top'] + monitor['top'])
+    return backend.grab(region, out=out), pos, (region['width'], region['height']), 1.0
+
+
+def run_case(backend, zoom, quality, codec, mode, frames, warmup, out_size):
+    monitor = backend.monitors()[1]
+    screen = (monitor['width'], monitor['height'])
+    timer = capture.StageTimer()
+    # Same buffer reuse as the server's FrameProducer
+    raw_ring, render_ring = frame_pipeline.FrameRing(2), frame_pipeline.FrameRing(2)
+    shape = None
+    latencies, sizes = [], []
+    for i in range(warmup + frames):
+        out = raw_ring.slot(shape) if shape and not backend.zero_copy else None
+        stage = time.perf_counter()
+        raw, pos, view, view_zoom = grab_view(backend, monitor, cursor_path(i, *screen), zoom, mode,
+                                              out=out)
+        shape = raw.shape
+        # The grab is where region capture saves time; it shows in
+        # stages_ms but, as before, not in the render/encode latency
+        started = timer.record('grab', stage)
+        dst = render_ring.slot((out_size[1], out_size[0], raw.shape[2]))
+        frame = frame_pipeline.render_frame(raw, pos, view, view_zoom, i % 25 == 0,
+                                            out_size=out_size, timer=timer, dst=dst)
+        stage = time.perf_counter()
+        data = frame_pipeline.encode_image(frame, quality, codec)
+        timer.record('encode', stage)
+        elapsed = time.perf_counter() - started
+        if i >= warmup:
+            latencies.append(elapsed)
+            sizes.append(len(data))
+    total = sum(latencies)
+    return {
+        'fps': round(len(latencies) / total, 1) if total else None,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'bytes_per_frame': int(np.mean(sizes)),
+        'stages_ms': timer.snapshot(),
+    }
+
+
+def run_pool_case(backend, zoom, quality, codec, mode, frames, warmup, out_size, workers):
+    monitor = backend.monitors()[1]
+    screen = (monitor['width'], monitor['height'])
+    variants = [(out_size[0], out_size[1], quality, codec)]
+    pool = frame_pipeline.EncodePool(workers, out_size, max_size=screen)
+    latencies, sizes = [], []
+    try:
+        started = None
+        for i in range(warmup + frames):
+            if i == warmup:
+                # Workers are spawned and warm by now; time from here
+                pool.drain()
+                started = time.perf_counter()
+            raw, pos, view, view_zoom = grab_view(backend, monitor, cursor_path(i, *screen), zoom, mode)
+            done = pool.submit(raw, pos, view, view_zoom, i % 25 == 0, variants)
+            if started is None:
+                continue
+            now = time.perf_counter()
+            for _, encoded, submitted in done:
+                latencies.append(now - submitted)
+                sizes.append(len(encoded[variants[0]]))
+        for _, encoded, submitted in pool.drain():
+            latencies.append(time.perf_counter() - submitted)
+            sizes.append(len(encoded[variants[0]]))
+        total = time.perf_counter() - started
+    finally:
+        pool.close()
+    return {
+        'fps': round(len(latencies) / total, 1) if total else None,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'bytes_per_frame': int(np.mean(sizes)),
+        'stages_ms': {},
+    }
+
+
+def case_key(result):
+    return (result['resolution'], result['zoom'], result['quality'], result.get('workers', 0),
+            result.get('codec', 'jpeg'), result.get('capture', 'full'))
+
+
+def case_label(result):
+    workers = result.get('workers', 0)
+    return (f"{result['resolution']:>10} zoom {result['zoom']:<4} "
+            f"{result.get('codec', 'jpeg'):<4} q{result['quality']:<3} "
+            f"{'inline' if not workers else f'{workers} proc':<7} {result.get('capture', 'full'):<6}")
+
+
+def compare(results, baseline_path, fail_over):
+    with open(baseline_path) as f:
+        baseline = {case_key(r): r for r in json.load(f)['results']}
+    regressions = 0
+    print(f"\nCompared with {baseline_path}:")
+    for result in results:
+        old = baseline.get(case_key(result))
+        if old is None:
+            continue
+        fps_change = (result['fps'] - old['fps']) / old['fps'] * 100
+        p99_change = (result['p99_ms'] - old['p99_ms']) / old['p99_ms'] * 100
+        flag = ''
+        if fail_over is not None and (fps_change < -fail_over or p99_change > fail_over):
+            regressions += 1
+            flag = '  <-- regression'
+        print(f"  {case_label(result)} fps {fps_change:+6.1f}%  p99 {p99_change:+6.1f}%{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--backend', default='synthetic', help="'synthetic' or 'replay:PATH'")
+    parser.add_argument('--resolutions', default='1280x720,1920x1080,2560x1440')
+    parser.add_argument('--zooms', default='1,2,4')
+    parser.add_argument('--qualities', default='30,60')
+    parser.add_argument('--codecs', default='jpeg', help='image codecs to run (jpeg, webp)')
+    parser.add_argument('--captures', default='full',
+                        help="zoomed capture modes to run: 'full' (grab and crop), 'region'")
+    parser.add_argument('--out-size', default='960x540', help='stream frame size')
+    parser.add_argument('--frames', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--workers', default='0',
+                        help='encode pool sizes to run, 0 = inline (e.g. 0,2,4)')
+    parser.add_argument('--change-every', type=int, default=1,
+                        help='synthetic frames change every N grabs')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--compare', help='baseline JSON from an earlier run')
+    parser.add_argument('--fail-over', type=float,
+                        help='exit 1 if fps drops or p99 grows by more than this percent')
+    args = parser.parse_args(argv)
+
+    out_size = parse_resolution(args.out_size)
+    resolutions = parse_list(args.resolutions, parse_resolution)
+    if args.backend != 'synthetic':
+        resolutions = [None]
+
+    results = []
+    for resolution in resolutions:
+        width, height = resolution or (0, 0)
+        backend = make_backend(args.backend, width, height, args.change_every)
+        with backend:
+            label = f"{backend.width}x{backend.height}"
+            for zoom in parse_list(args.zooms, float):
+                for quality, codec, workers, mode in itertools.product(
+                        parse_list(args.qualities, int), parse_list(args.codecs, str),
+                        parse_list(args.workers, int), parse_list(args.captures, str)):
+                    if mode == 'region' and zoom <= 1.0:
+                        continue  # Same as 'full' without zoom
+                    result = {'resolution': label, 'zoom': zoom, 'quality': quality,
+                              'codec': codec, 'workers': workers, 'capture': mode}
+                    if workers:
+                        result.update(run_pool_case(backend, zoom, quality, codec, mode, args.frames,
+                                                    args.warmup, out_size, workers))
+                    else:
+                        result.update(run_case(backend, zoom, quality, codec, mode, args.frames,
+                                               args.warmup, out_size))
+                    results.append(result)
+                    print(f"{case_label(result)} {result['fps']:>7} fps  p50 {result['p50_ms']:>7.2f} ms  "
+                          f"p99 {result['p99_ms']:>7.2f} ms  {result['bytes_per_frame']:>7} B/frame")
+
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'opencv': cv2.__version__,
+            'numpy': np.__version__,
+            'backend': args.backend,
+            'out_size': args.out_size,
+            'frames': args.frames,
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nSaved results to {args.output}")
+    if args.compare and compare(results, args.compare, args.fail_over):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,235 @@
+"""Screen capture backends used by the shared frame producer.
+
+Every backend grabs one monitor at a time and returns a ``uint8`` image
+of shape ``(h, w, 3)`` (BGR) or ``(h, w, 4)`` (BGRA). The rest of the
+pipeline (resize, cursor overlay, JPEG encode) accepts either layout, so
+a backend that can hand out BGRA without copying should do so.
+
+``grab(monitor, out=...)`` writes the frame into a caller-owned array
+of the right shape instead of allocating one (see frame_pipeline's
+FrameRing). A backend whose frames are already views of a buffer it got
+for free (``zero_copy``) only copies when ``out`` is passed.
+
+Pick one with ``CAPTURE_BACKEND``:
+
+- ``mss``           mss grab converted BGRA -> BGR
+- ``mss-zerocopy``  the mss buffer wrapped in place, kept as BGRA
+- ``synthetic``     generated desktop-like frames, no display needed
+- ``replay:PATH``   frames from a video file or a directory of images
+"""
+import os
+import time
+
+import cv2
+import numpy as np
+
+
+class CaptureBackend:
+    """Base class: ``with backend:`` opens it, ``grab(monitor)`` captures.
+
+    ``monitors()`` follows the mss convention: index 0 is the whole
+    virtual desktop, 1..n are the individual monitors, each a dict with
+    ``left``, ``top``, ``width`` and ``height``.
+    """
+
+    name = 'base'
+    zero_copy = False
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def monitors(self):
+        raise NotImplementedError
+
+    def grab(self, monitor, out=None):
+        raise NotImplementedError
+
+    def _write(self, frame, out):
+        """Copy ``frame`` into ``out`` when it fits, else return ``frame`` itself."""
+        if out is None or out.shape != frame.shape:
+            return frame
+        np.copyto(out, frame)
+        return out
+
+
+class MssCapture(CaptureBackend):
+    """The mss grab converted to BGR (into ``out`` when given)."""
+
+    name = 'mss'
+
+    def __init__(self):
+        self.sct = None
+
+    def open(self):
+        import mss
+        self.sct = mss.mss()
+
+    def close(self):
+        if self.sct is not None:
+            self.sct.close()
+            self.sct = None
+
+    def monitors(self):
+        return self.sct.monitors
+
+    def grab(self, monitor, out=None):
+        shot = self.sct.grab(monitor)
+        bgra = np.frombuffer(shot.raw, dtype=np.uint8).reshape(shot.height, shot.width, 4)
+        return cv2.cvtColor(bgra, cv2.COLOR_BGRA2BGR, dst=out)
+
+
+class MssZeroCopyCapture(MssCapture):
+    """Wraps the mss buffer with ``np.frombuffer`` and keeps it BGRA.
+
+    mss hands out a fresh buffer per grab, so the view stays valid while
+    the frame is processed; OpenCV resizes and JPEG-encodes BGRA directly.
+    """
+
+    name = 'mss-zerocopy'
+    zero_copy = True
+
+    def grab(self, monitor, out=None):
+        shot = self.sct.grab(monitor)
+        return self._write(np.frombuffer(shot.raw, dtype=np.uint8).reshape(shot.height, shot.width, 4), out)
+
+
+class SyntheticCapture(CaptureBackend):
+    """Deterministic desktop-like frames for tests and benchmarks.
+
+    A static background with a few "windows" and a block of text, plus a
+    small box that moves every ``change_every`` frames so change detection
+    and delta encoding have something to find.
+    """
+
+    name = 'synthetic'
+
+    def __init__(self, width=1920, height=1080, change_every=1):
+        self.width = width
+        self.height = height
+        self.change_every = max(1, change_every)
+        self.frame_no = 0
+        self.background = None
+
+    def open(self):
+        h, w = self.height, self.width
+        bg = np.empty((h, w, 4), dtype=np.uint8)
+        bg[...] = (90, 60, 30, 255)
+        bg[:, :, 0] += (np.arange(w) * 80 // max(1, w)).astype(np.uint8)
+        for i, (x, y) in enumerate([(0.05, 0.08), (0.4, 0.2), (0.15, 0.5)]):
+            x1, y1 = int(x * w), int(y * h)
+            x2, y2 = min(w, x1 + w // 3), min(h, y1 + h // 3)
+            cv2.rectangle(bg, (x1, y1), (x2, y2), (245, 245, 245, 255), -1)
+            cv2.rectangle(bg, (x1, y1), (x2, y1 + 24), (120, 80, 40, 255), -1)
+            for line in range(1, (y2 - y1) // 18):
+                cv2.putText(bg, f"window {i} line {line} lorem ipsum dolor sit amet",
+                            (x1 + 8, y1 + 24 + line * 18), cv2.FONT_HERSHEY_SIMPLEX,
+                            0.45, (20, 20, 20, 255), 1, cv2.LINE_AA)
+        self.background = bg
+
+    def monitors(self):
+        mon = {'left': 0, 'top': 0, 'width': self.width, 'height': self.height}
+        return [mon, dict(mon)]
+
+    def grab(self, monitor, out=None):
+        step = self.frame_no // self.change_every
+        self.frame_no += 1
+        region = self._region(self.background, monitor)
+        frame = self._write(region, out)
+        if frame is region:
+            frame = region.copy()
+        x = (step * 37) % max(1, self.width - 120) - monitor['left']
+        y = (step * 23) % max(1, self.height - 80) - monitor['top']
+        cv2.rectangle(frame, (x, y), (x + 120, y + 80), (40, 40, 220, 255), -1)
+        return frame
+
+    def _region(self, frame, monitor):
+        x, y = monitor['left'], monitor['top']
+        return frame[y:y + monitor['height'], x:x + monitor['width']]
+
+
+class ReplayCapture(SyntheticCapture):
+    """Loops over recorded frames from a video file or an image directory."""
+
+    name = 'replay'
+    zero_copy = True
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.frames = []
+
+    def open(self):
+        if os.path.isdir(self.path):
+            names = sorted(os.listdir(self.path))
+            frames = [cv2.imread(os.path.join(self.path, n), cv2.IMREAD_COLOR) for n in names]
+        else:
+            frames = []
+            video = cv2.VideoCapture(self.path)
+            while True:
+                ok, frame = video.read()
+                if not ok:
+                    break
+                frames.append(frame)
+            video.release()
+        self.frames = [f for f in frames if f is not None]
+        if not self.frames:
+            raise ValueError(f"No frames found in {self.path}")
+        self.height, self.width = self.frames[0].shape[:2]
+
+    def grab(self, monitor, out=None):
+        frame = self.frames[self.frame_no % len(self.frames)]
+        self.frame_no += 1
+        return self._write(self._region(frame, monitor), out)
+
+
+BACKENDS = {
+    'mss': MssCapture,
+    'mss-zerocopy': MssZeroCopyCapture,
+    'synthetic': SyntheticCapture,
+}
+
+
+def open_backend(spec):
+    """Build a backend from a ``CAPTURE_BACKEND`` value such as ``replay:demo.mp4``."""
+    name, _, arg = spec.partition(':')
+    if name == 'replay':
+        return ReplayCapture(arg)
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown capture backend {spec!r} (choose from {', '.join(BACKENDS)}, replay:PATH)")
+    return BACKENDS[name]()
+
+
+class StageTimer:
+    """Smoothed per-stage timings (milliseconds) for one pipeline.
+
+    If a ``histogram`` (see metrics.py) is given, every sample is also
+    observed there in seconds with a ``stage`` label.
+    """
+
+    def __init__(self, alpha=0.1, histogram=None):
+        self.alpha = alpha
+        self.histogram = histogram
+        self.stages = {}
+
+    def record(self, stage, started):
+        """Record the time since ``started`` (a ``time.perf_counter()`` value)."""
+        now = time.perf_counter()
+        ms = (now - started) * 1000
+        prev = self.stages.get(stage)
+        self.stages[stage] = ms if prev is None else prev + self.alpha * (ms - prev)
+        if self.histogram is not None:
+            self.histogram.observe(now - started, stage=stage)
+        return now
+
+    def snapshot(self):
+        return {stage: round(ms, 3) for stage, ms in self.stages.items()}
@@ -0,0 +1,495 @@
+"""Frame processing shared by the live stream and the benchmarks.
+
+Everything here is pure NumPy/OpenCV: no display, mouse or audio is
+touched, so the same code the server runs per frame can be driven from
+recorded or synthetic captures (see benchmark.py). ``EncodePool`` runs
+the render/encode half in worker processes for multi-core hosts.
+"""
+import collections
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+STREAM_SIZE = (960, 540)
+CURSOR_COLOR = (74, 158, 255)
+CLICK_COLOR = (0, 255, 0)
+
+
+class _NoTimer:
+    def record(self, stage, started):
+        return time.perf_counter()
+
+
+NO_TIMER = _NoTimer()
+
+
+class FrameRing:
+    """A few preallocated frame buffers handed out round-robin.
+
+    A buffer stays untouched until ``slots`` more have been handed out,
+    so with two slots the previous frame survives while the next one is
+    written. All slots are reallocated if the requested shape changes.
+    """
+
+    def __init__(self, slots=2, dtype=np.uint8):
+        self.slots = slots
+        self.dtype = dtype
+        self.buffers = []
+        self.index = 0
+
+    def slot(self, shape):
+        shape = tuple(shape)
+        if not self.buffers or self.buffers[0].shape != shape:
+            self.buffers = [np.empty(shape, dtype=self.dtype) for _ in range(self.slots)]
+        self.index = (self.index + 1) % self.slots
+        return self.buffers[self.index]
+
+
+class ChangeDetector:
+    """Exact change check of each capture against a copy of the last one.
+
+    ``update(img)`` compares every byte with the previous capture (about
+    2 ms at 1080p, less than the render and encode it saves), so any
+    edit counts, however small. A changed capture is copied in as the
+    new reference. With ``box=True`` it also returns the bounding box
+    ``(x, y, w, h)`` of the changed pixels; the box is None for the
+    first capture and after a shape change.
+    """
+
+    def __init__(self):
+        self.previous = None
+
+    def reset(self):
+        self.previous = None
+
+    def update(self, img, box=False):
+        """Returns ``(changed, box)``."""
+        previous = self.previous
+        if previous is None or previous.shape != img.shape:
+            self.previous = img.copy()
+            return True, None
+        if np.array_equal(img, previous):
+            return False, None
+        rect = changed_box(previous, img) if box else None
+        np.copyto(previous, img)
+        return True, rect
+
+
+def changed_box(previous, img):
+    """Bounding box ``(x, y, w, h)`` of the pixels that differ between two
+    same-shape captures, None if they are equal."""
+    h, w, channels = img.shape
+    diff = previous.reshape(h, w * channels) != img.reshape(h, w * channels)
+    rows = np.flatnonzero(diff.any(axis=1))
+    if not len(rows):
+        return None
+    cols = np.flatnonzero(diff[rows[0]:rows[-1] + 1].any(axis=0)) // channels
+    x, y = int(cols[0]), int(rows[0])
+    return x, y, int(cols[-1]) + 1 - x, int(rows[-1]) + 1 - y
+
+
+def zoom_rect(full_w, full_h, pos, screen_size, zoom):
+    """Capture-pixel rectangle (x1, y1, x2, y2) shown at ``zoom`` around ``pos``.
+
+    ``pos`` is the cursor in screen coordinates and ``screen_size`` the
+    screen size in those coordinates; the capture may be larger on
+    high-DPI displays.
+    """
+    if zoom <= 1.0:
+        return 0, 0, full_w, full_h
+    pos_x, pos_y = pos
+    screen_w, screen_h = screen_size
+    new_h = int(full_h / zoom)
+    new_w = int(full_w / zoom)
+
+    # Centered on the *screen* mouse position
+    center_x = int(pos_x * full_w / screen_w)
+    center_y = int(pos_y * full_h / screen_h)
+
+    x1 = max(0, center_x - new_w // 2)
+    y1 = max(0, center_y - new_h // 2)
+    x2 = min(full_w, x1 + new_w)
+    y2 = min(full_h, y1 + new_h)
+
+    # Edge correction
+    if x2 - x1 < new_w:
+        x1 = max(0, x2 - new_w)
+    if y2 - y1 < new_h:
+        y1 = max(0, y2 - new_h)
+    return x1, y1, x2, y2
+
+
+def zoom_region(monitor, pos, zoom):
+    """The part of ``monitor`` shown at ``zoom`` around ``pos``, as a
+    monitor dict for ``grab``.
+
+    The same rectangle as zoom_rect but in screen coordinates, so the
+    backend captures only what will be shown; render it with zoom 1.0,
+    the region's size as the screen size and ``pos`` made relative to it.
+    """
+    width, height = monitor['width'], monitor['height']
+    x1, y1, x2, y2 = zoom_rect(width, height, pos, (width, height), zoom)
+    return {'left': monitor['left'] + x1, 'top': monitor['top'] + y1,
+            'width': x2 - x1, 'height': y2 - y1}
+
+
+def render_frame(raw_frame, pos, screen_size, zoom=1.0, clicked=False,
+                 out_size=STREAM_SIZE, timer=NO_TIMER, dst=None, cursor=True):
+    """Crop (when zoomed), resize to ``out_size`` and draw the cursor.
+
+    ``raw_frame`` is a BGR or BGRA capture; the result has the same
+    channel layout and is written into ``dst`` if that fits.
+    ``timer`` gets crop/resize/cursor stage samples. With ``cursor``
+    False the cursor is left to the viewer (``pos`` still steers the zoom).
+    """
+    out_w, out_h = out_size
+    pos_x, pos_y = pos
+    screen_w, screen_h = screen_size
+    stage = time.perf_counter()
+
+    # Original capture size (might differ from screen_size on high‑DPI displays)
+    full_h, full_w = raw_frame.shape[:2]
+
+    if zoom > 1.0:
+        # ---- ZOOM REGION ----
+        x1, y1, x2, y2 = zoom_rect(full_w, full_h, pos, screen_size, zoom)
+        frame_crop = raw_frame[y1:y2, x1:x2]
+        stage = timer.record('crop', stage)
+
+        # ------- CURSOR OVERLAY CALCULATION -------
+        region_x_screen = x1 * screen_w / full_w
+        region_y_screen = y1 * screen_h / full_h
+        region_w_screen = (x2 - x1) * screen_w / full_w
+        region_h_screen = (y2 - y1) * screen_h / full_h
+
+        rel_x = (pos_x - region_x_screen) / region_w_screen
+        rel_y = (pos_y - region_y_screen) / region_h_screen
+
+        # Clamp just in case
+        rel_x = max(0, min(rel_x, 1))
+        rel_y = max(0, min(rel_y, 1))
+
+        cx = int(rel_x * out_w)
+        cy = int(rel_y * out_h)
+
+        # Resize for streaming
+        frame = cv2.resize(frame_crop, (out_w, out_h), dst=dst)
+    else:
+        # No zoom – direct scaling
+        cx = int(pos_x * out_w / screen_w)
+        cy = int(pos_y * out_h / screen_h)
+        frame = cv2.resize(raw_frame, (out_w, out_h), dst=dst)
+    stage = timer.record('resize', stage)
+
+    if cursor:
+        draw_cursor(frame, cx, cy, clicked)
+        timer.record('cursor', stage)
+
+    return frame
+
+
+def draw_cursor(frame, cx, cy, clicked=False):
+    """Cursor ring at (cx, cy) plus a wider ring while a click is fresh."""
+    h, w = frame.shape[:2]
+    if 0 <= cx < w and 0 <= cy < h:
+        cv2.circle(frame, (cx, cy), 12, CURSOR_COLOR, 2)
+        cv2.circle(frame, (cx, cy), 2, CURSOR_COLOR, -1)
+
+        # Click visual feedback
+        if clicked:
+            cv2.circle(frame, (cx, cy), 30, CLICK_COLOR, 3)
+
+
+def roi_rect(full_w, full_h, center, size):
+    """A ``size`` (w, h) rectangle (x, y, w, h) centred on ``center``, kept inside the frame."""
+    w, h = min(size[0], full_w), min(size[1], full_h)
+    x = min(max(0, int(center[0]) - w // 2), full_w - w)
+    y = min(max(0, int(center[1]) - h // 2), full_h - h)
+    return x, y, w, h
+
+
+def merge_rects(rects):
+    """Replace overlapping (x, y, w, h) rectangles by their bounding boxes."""
+    merged = []
+    for rect in rects:
+        x, y, w, h = rect
+        i = 0
+        while i < len(merged):
+            mx, my, mw, mh = merged[i]
+            if x < mx + mw and mx < x + w and y < my + mh and my < y + h:
+                x2, y2 = max(x + w, mx + mw), max(y + h, my + mh)
+                x, y = min(x, mx), min(y, my)
+                w, h = x2 - x, y2 - y
+                merged.pop(i)
+                i = 0
+            else:
+                i += 1
+        merged.append((x, y, w, h))
+    return merged
+
+
+def encode_roi(raw_frame, rects, bg_size, bg_quality, patch_quality, cursor=None,
+               clicked=False, scratch=None, background=True, budget=None, min_quality=30):
+    """A soft background of the whole capture plus sharp native-resolution patches.
+
+    Returns ``(background, patches)``: ``((x, y, w, h), jpeg)`` parts in
+    capture pixels, the background None unless asked for. The client
+    scales the background up to the full rectangle and draws the
+    patches over it. ``cursor`` (capture pixels) is drawn into the
+    patches. ``scratch`` (a dict) keeps the background buffer and the
+    patch quality that last fit.
+
+    With a byte ``budget`` for the whole message, patches step down from
+    ``patch_quality`` to ``min_quality``; if that is still too much only
+    the first patch (the cursor's) is kept, halved in size if need be.
+    """
+    scratch = scratch if scratch is not None else {}
+    full_h, full_w = raw_frame.shape[:2]
+    bg_part = None
+    if background:
+        bg = cv2.resize(raw_frame, bg_size, dst=scratch.get('background'), interpolation=cv2.INTER_AREA)
+        scratch['background'] = bg
+        bg_part = ((0, 0, full_w, full_h), encode_jpeg(bg, bg_quality))
+    if budget is not None:
+        budget -= len(bg_part[1]) if bg_part else 0
+    # Start from the quality that fit last time, one step up
+    quality = min(patch_quality, scratch.get('patch_quality', patch_quality) + 15)
+    while True:
+        patches = _encode_patches(raw_frame, rects, quality, cursor, clicked)
+        size = sum(len(data) for _, data in patches)
+        if budget is None or size <= budget:
+            break
+        if quality > min_quality:
+            quality = max(min_quality, quality - 15)
+        elif len(rects) > 1:
+            rects = rects[:1]
+        elif rects and rects[0][2] > 160:
+            x, y, w, h = rects[0]
+            rects = [(x + w // 4, y + h // 4, w // 2, h // 2)]
+        else:
+            break
+    scratch['patch_quality'] = quality
+    return bg_part, patches
+
+
+def _encode_patches(raw_frame, rects, quality, cursor, clicked):
+    parts = []
+    for x, y, w, h in rects:
+        patch = raw_frame[y:y + h, x:x + w]
+        if cursor is not None:
+            patch = patch.copy()
+            draw_cursor(patch, cursor[0] - x, cursor[1] - y, clicked)
+        parts.append(((x, y, w, h), encode_jpeg(patch, quality)))
+    return parts
+
+
+IMAGE_CODECS = {
+    'jpeg': ('.jpg', cv2.IMWRITE_JPEG_QUALITY),
+    'webp': ('.webp', cv2.IMWRITE_WEBP_QUALITY),
+}
+
+
+def encode_image(frame, quality, codec='jpeg'):
+    extension, flag = IMAGE_CODECS[codec]
+    if codec == 'webp' and frame.shape[2] == 4:
+        # The alpha channel is constant; don't make libwebp carry it
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGRA2BGR)
+    _, buffer = cv2.imencode(extension, frame, [flag, quality])
+    return buffer.tobytes()
+
+
+def encode_jpeg(frame, quality):
+    return encode_image(frame, quality, 'jpeg')
+
+
+def encode_variants(frame, variants, scratch=None):
+    """One image per (width, height, quality, codec) variant of ``frame``.
+
+    Each distinct size is resized once and shared by its qualities. The
+    resized frames are written into the arrays kept in ``scratch`` (a
+    dict reused between calls) when given.
+    """
+    resized = {(frame.shape[1], frame.shape[0]): frame}
+    encoded = {}
+    for width, height, quality, codec in variants:
+        scaled = resized.get((width, height))
+        if scaled is None:
+            dst = scratch.get((width, height)) if scratch is not None else None
+            scaled = cv2.resize(frame, (width, height), dst=dst, interpolation=cv2.INTER_AREA)
+            resized[(width, height)] = scaled
+            if scratch is not None:
+                scratch[(width, height)] = scaled
+        encoded[(width, height, quality, codec)] = encode_image(scaled, quality, codec)
+    return encoded
+
+
+# Worker-process side of EncodePool: views of the shared slots.
+_worker_shm = None
+_worker_inputs = None
+_worker_outputs = None
+_worker_scratch = {}
+
+
+def _slot_views(buf, slots, in_shape, out_shape):
+    in_bytes = slots * int(np.prod(in_shape))
+    inputs = np.ndarray((slots,) + in_shape, dtype=np.uint8, buffer=buf)
+    outputs = np.ndarray((slots,) + out_shape, dtype=np.uint8, buffer=buf, offset=in_bytes)
+    return inputs, outputs
+
+
+def _attach_worker(name, slots, in_shape, out_shape):
+    global _worker_shm, _worker_inputs, _worker_outputs
+    # Attaching registers the block with the resource tracker the worker
+    # shares with the parent, which already has it; the parent unlinks it.
+    _worker_shm = shared_memory.SharedMemory(name=name)
+    _worker_inputs, _worker_outputs = _slot_views(_worker_shm.buf, slots, in_shape, out_shape)
+
+
+def _frame_view(buf, size, channels):
+    """A contiguous (h, w, channels) view at the start of a larger slot."""
+    width, height = size
+    return buf.reshape(-1)[:height * width * channels].reshape(height, width, channels)
+
+
+def _encode_slot(slot, in_size, pos, screen_size, zoom, clicked, variants, out_size, want_frame,
+                 cursor):
+    channels = _worker_inputs.shape[3]
+    raw = _frame_view(_worker_inputs[slot], in_size, channels)
+    out = _frame_view(_worker_outputs[slot], out_size, channels)
+    frame = render_frame(raw, pos, screen_size, zoom, clicked, out_size, dst=out, cursor=cursor)
+    if want_frame and not np.may_share_memory(frame, out):
+        out[...] = frame
+    return encode_variants(frame, variants, _worker_scratch)
+
+
+class EncodePool:
+    """Render and encode frames in worker processes, results in capture order.
+
+    Raw captures live in shared-memory slots, one per job in flight, so
+    only a few small arguments and the JPEG bytes cross the process
+    boundary; ``slot(shape)`` hands out the next free slot so a capture
+    backend can grab straight into it. Slots are sized for ``max_size``
+    (the whole monitor) and a smaller capture, such as a zoomed region,
+    is written into a view at the start of one, so zoom steps never
+    respawn the workers; only a capture that does not fit does. Workers
+    render into a matching output slot sized for ``out_size``, the
+    largest frame a job may ask for. ``submit`` blocks only while every worker is busy
+    and returns the jobs that have finished, oldest first: a frame is
+    never handed back before one captured earlier, however the workers
+    race. Workers are spawned on the first submit.
+    """
+
+    def __init__(self, workers, out_size=STREAM_SIZE, max_size=None):
+        self.workers = max(1, workers)
+        self.out_size = out_size
+        self.max_size = max_size
+        self.executor = None
+        self.shm = None
+        self.shape = None
+        self.pending = collections.deque()
+        self.free = []
+        self.reserved = None
+        self.completed = []
+
+    def _fits(self, shape):
+        return (self.shape is not None and shape[2] == self.shape[2]
+                and shape[0] <= self.shape[0] and shape[1] <= self.shape[1])
+
+    def _allocate(self, shape):
+        self.close()
+        out_w, out_h = self.out_size
+        max_w, max_h = self.max_size or (0, 0)
+        in_shape = (max(shape[0], max_h), max(shape[1], max_w), shape[2])
+        out_shape = (out_h, out_w, shape[2])
+        slots = self.workers
+        size = slots * (int(np.prod(in_shape)) + int(np.prod(out_shape)))
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        self.inputs, self.outputs = _slot_views(self.shm.buf, slots, in_shape, out_shape)
+        self.executor = ProcessPoolExecutor(
+            slots, mp_context=multiprocessing.get_context('spawn'),
+            initializer=_attach_worker, initargs=(self.shm.name, slots, in_shape, out_shape))
+        self.shape = in_shape
+        self.free = list(range(slots))
+
+    def slot(self, shape):
+        """A ``shape`` view of the slot the next ``submit`` will use,
+        reserved until then.
+
+        Blocks for the oldest job if every slot is busy; jobs finished
+        along the way are returned by the next submit/ready/drain.
+        """
+        if not self._fits(shape):
+            self.completed += self.drain()
+            self._allocate(shape)
+        if self.reserved is None:
+            if not self.free:
+                self.completed.append(self._collect(self.pending.popleft()))
+            self.reserved = self.free.pop()
+        return _frame_view(self.inputs[self.reserved], (shape[1], shape[0]), shape[2])
+
+    def submit(self, raw, pos, screen_size, zoom=1.0, clicked=False, variants=(), want_frame=False,
+               out_size=None, cursor=True):
+        """Queue one capture; returns finished ``(frame, jpegs, submitted)`` jobs.
+
+        ``raw`` is copied into a slot unless it already is the one from
+        ``slot()``; it is rendered at ``out_size`` (default: the pool's).
+        ``frame`` is the rendered frame (a copy) if
+        ``want_frame`` was set for that job, else None; ``submitted`` is
+        its ``perf_counter()`` submit time.
+        """
+        target = self.slot(raw.shape)
+        if not np.may_share_memory(raw, target):
+            np.copyto(target, raw)
+        slot, self.reserved = self.reserved, None
+        out_size = out_size or self.out_size
+        in_size = (raw.shape[1], raw.shape[0])
+        future = self.executor.submit(_encode_slot, slot, in_size, pos, screen_size, zoom, clicked,
+                                      list(variants), out_size, want_frame, cursor)
+        self.pending.append((slot, future, want_frame and out_size, time.perf_counter()))
+        return self.ready()
+
+    def ready(self):
+        """Finished jobs at the head of the queue, without blocking."""
+        ready, self.completed = self.completed, []
+        while self.pending and self.pending[0][1].done():
+            ready.append(self._collect(self.pending.popleft()))
+        return ready
+
+    def drain(self):
+        """Wait for every job in flight."""
+        ready, self.completed = self.completed, []
+        while self.pending:
+            ready.append(self._collect(self.pending.popleft()))
+        return ready
+
+    def _collect(self, job):
+        slot, future, frame_size, submitted = job
+        try:
+            encoded = future.result()
+        except BrokenProcessPool:
+            self.close()
+            raise
+        frame = None
+        if frame_size:
+            frame = _frame_view(self.outputs[slot], frame_size, self.shape[2]).copy()
+        self.free.append(slot)
+        return frame, encoded, submitted
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        if self.shm is not None:
+            self.inputs = self.outputs = None
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+        self.shape = None
+        self.pending.clear()
+        self.free = []
+        self.reserved = None
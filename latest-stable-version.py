@@ -1,41 +1,359 @@
 import os
 import time
+import asyncio
+import threading
 import cv2
 import numpy as np
-import mss
 import pyautogui
 from flask import Flask, render_template_string, request, Response, session, redirect, url_for, jsonify
+from flask.sessions import SecureCookieSessionInterface
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.datastructures import MultiDict
+from werkzeug.http import parse_cookie
+from itsdangerous import BadSignature
 from datetime import timedelta
 import json
-from pycaw.pycaw import AudioUtilities, IAudioEndpointVolume
-from comtypes import CLSCTX_ALL
-from ctypes import cast, POINTER
+import secrets
+import struct
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+import audio
+import capture
+import frame_pipeline
+import metrics
+import video_codec
+
+try:
+    from flask_sock import Sock
+    from simple_websocket import ConnectionClosed
+except ImportError:
+    Sock = None
+
+try:
+    import pyperclip
+except ImportError:
+    pyperclip = None
+
+try:
+    import uvicorn
+    from asgiref.wsgi import WsgiToAsgi
+except ImportError:
+    uvicorn = None
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("SECRET_KEY", "night_shift_joystick_secure_v2")
+sock = Sock(app) if Sock else None
 
 # --- CONFIGURATION ---
-PASSWORD_HASH = generate_password_hash(os.environ.get("REMOTE_PASS", "idk"))
-SCREEN_W, SCREEN_H = pyautogui.size()
+# Hashed at startup, in the __main__ block: hashing is deliberately slow
+# and EncodePool workers re-import this script
+PASSWORD_HASH = None
+# Sessions end SESSION_LIFETIME after login: the cookie is not re-signed
+# on every request, so its signature dates from the login.
+SESSION_LIFETIME = timedelta(hours=2)
+app.permanent_session_lifetime = SESSION_LIFETIME
+app.config['SESSION_REFRESH_EACH_REQUEST'] = False
 pyautogui.FAILSAFE = False
 zoom_factor = 1.0
-zoom_center_x = SCREEN_W // 2
-zoom_center_y = SCREEN_H // 2
 last_click_time = 0
+last_click_pos = (0, 0)
+
+# "threaded" runs Flask's dev server; "async" runs the ASGI app on uvicorn
+SERVER_MODE = os.environ.get("SERVER_MODE", "threaded")
+
+# Bearer token that lets a Prometheus scraper read /metrics without logging in
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+
+# Screen grabber, see capture.py: mss, mss-zerocopy, synthetic, replay:PATH
+CAPTURE_BACKEND = os.environ.get("CAPTURE_BACKEND", "mss-zerocopy")
+
+FRAME_INTERVAL = 0.04  # ~25 FPS capture
+
+# When the last viewer leaves (or every viewer's page is hidden) capture
+# pauses, but the backend and the last frames are kept this long
+# (seconds) so a reconnect shows a frame at once.
+CAPTURE_LINGER = float(os.environ.get("CAPTURE_LINGER", "15"))
+
+# Worker processes that render/encode frames in parallel (0 = inline on
+# the capture thread). Worth it for high resolutions on multi-core hosts.
+ENCODE_WORKERS = int(os.environ.get("ENCODE_WORKERS", "0"))
+
+# A 960x540 WebP frame takes about 40 ms to encode, the whole frame
+# interval, so once anyone watches WebP the frames go through a pool of
+# this many workers even with ENCODE_WORKERS=0. With 0 here WebP is
+# encoded inline and caps the capture rate near 20 FPS for every viewer.
+WEBP_ENCODE_WORKERS = int(os.environ.get("WEBP_ENCODE_WORKERS", "2"))
+
+# Unchanged frames are not re-encoded; idle streams get the last frame
+# resent every KEEPALIVE_INTERVAL seconds instead.
+KEEPALIVE_INTERVAL = 5.0
+
+# /state_stream sends at most one event per STATE_MIN_INTERVAL seconds
+# (bursts of changes coalesce) and a health event when idle for
+# KEEPALIVE_INTERVAL.
+STATE_MIN_INTERVAL = 0.1
+
+# Tile delta streaming (/tiles WebSocket): only changed TILE_SIZE squares
+# of the stream frame are encoded and sent.
+TILE_SIZE = 64
+TILE_QUALITY = 50
+MSG_TILES = 1
+
+# Region-of-interest mode (/tiles?mode=roi): a soft full-screen background
+# plus sharp native-resolution patches around the cursor, the last click
+# and small changed areas, composited by the client. Patch sizes are in
+# capture pixels; bigger changes (scrolling, video) only get the background.
+# The background is only sent when the capture changed (MSG_ROI); pointer
+# moves over a still desktop send patches over the client's last
+# background (MSG_ROI_PATCHES). Patch quality, then patch count and size,
+# drop to keep each message under ROI_BYTE_BUDGET, about one 960x540
+# q30 MJPEG frame.
+MSG_ROI = 2
+MSG_ROI_PATCHES = 3
+ROI_BG_QUALITY = 20
+ROI_PATCH_QUALITY = 80
+ROI_MIN_QUALITY = 30
+ROI_BYTE_BUDGET = 28 * 1024
+ROI_PATCH_SIZE = (640, 360)
+ROI_CLICK_SIZE = (320, 180)
+ROI_CLICK_SECONDS = 2.0
+ROI_MAX_CHANGED_AREA = 640 * 360
+
+# Stream renditions a viewer can ask for (?rendition=720p) or get picked
+# from its viewport (?vw=&vh=&dpr=). Only renditions someone watches are
+# rendered and encoded, each once per frame however many viewers share it.
+RENDITIONS = {
+    '480p': (854, 480),
+    '540p': (960, 540),
+    '720p': (1280, 720),
+    '1080p': (1920, 1080),
+}
+DEFAULT_RENDITION = '540p'
+
+# Adaptive MJPEG: each viewer moves along its rendition's quality ladder
+# (width, height, JPEG quality) to keep frame writes under its latency
+# target. The ladder starts at the rendition and falls back through the
+# smaller ones; the settings panel's quality choice picks the best rung a
+# viewer may use.
+LADDER_TAIL = [(640, 360, 25), (480, 270, 20)]
+QUALITY_PRESETS = {'high': 0, 'medium': 1, 'low': 3}
+TARGET_LATENCY_MS = float(os.environ.get("STREAM_LATENCY_MS", 150))
+BANDWIDTH_CAP_KBPS = float(os.environ.get("STREAM_KBPS", 0))
+MAX_FPS = 25
+MIN_FPS = 2
+
+# H.264 stream (/video_mp4, needs PyAV): x264 constant quality (lower is
+# better, 23 is x264's default), a keyframe at least every
+# VIDEO_KEYFRAME_INTERVAL frames so late joiners start quickly, and a
+# fast preset so encoding keeps up on the capture thread. STREAM_KBPS
+# also caps the H.264 bitrate.
+VIDEO_CRF = int(os.environ.get("VIDEO_CRF", 28))
+VIDEO_KEYFRAME_INTERVAL = 50
+VIDEO_PRESET = 'veryfast'
+
+# Input events arriving early over /input wait this long (seconds) for
+# the missing sequence numbers before the gap is skipped.
+INPUT_REORDER_WINDOW = 0.2
+
+# Pages drawing the cursor themselves get its position this often (Hz)
+# over /input.
+CURSOR_HZ = 30
+
+# /action and /ping accept a token in the X-Action-Token header instead of
+# the session cookie (a header, so it stays out of the access log); the
+# page gets a token this long-lived (seconds) and renews it from
+# /action_token.
+ACTION_TOKEN_SECONDS = 600
+ACTION_TOKEN_HEADER = 'X-Action-Token'
+
+# Typed text runs on its own thread. Text of TYPE_PASTE_MIN characters
+# or more, or with characters the keyboard can't type, is pasted through
+# the clipboard (needs pyperclip); the rest is typed TYPE_CHUNK characters
+# at a time so a cancel takes effect quickly.
+TYPE_PASTE_MIN = int(os.environ.get("TYPE_PASTE_MIN", 32))
+TYPE_INTERVAL = 0.01
+TYPE_CHUNK = 20
+
+# Joystick velocity mode: the cursor is moved JOY_TICK_HZ times a second.
+# move_joy moved x*2 px per 40 ms tick, so a joy_vel of x is x*50 px/s.
+JOY_TICK_HZ = 120
+JOY_SPEED_SCALE = 2 / 0.04
+JOY_VELOCITY_TIMEOUT = 1.0
+
+# The cursor position and screen size are re-read from the OS this often
+# (seconds); in between, the server's own moves keep them current. The
+# poll stops after SCREEN_IDLE_SECONDS without anyone asking.
+SCREEN_POLL_INTERVAL = 0.25
+SCREEN_IDLE_SECONDS = 5.0
 
 # Track held keys
 held_keys = set()
 
-# Initialize audio control
-try:
-    devices = AudioUtilities.GetSpeakers()
-    interface = devices.Activate(IAudioEndpointVolume._iid_, CLSCTX_ALL, None)
-    volume = cast(interface, POINTER(IAudioEndpointVolume))
-    audio_available = True
-except:
-    audio_available = False
-    volume = None
+# System volume, see audio.py: auto, pycaw, pulse, mock, none. Slider
+# moves are applied at most once per VOLUME_TICK seconds (latest level
+# wins) on one worker thread that owns the audio endpoint.
+AUDIO_BACKEND = os.environ.get("AUDIO_BACKEND", "auto")
+VOLUME_TICK = 0.05
+
+# --- SCREEN STATE ---
+class ScreenState:
+    """Cursor position and screen geometry without an OS call per frame.
+
+    Every move the server makes goes through move_to/move_by, which keep
+    the cached position current; while they are in use, a background
+    poll every SCREEN_POLL_INTERVAL picks up moves made with the local mouse and
+    re-reads the screen size, so a resolution change takes effect
+    without a restart (``generation`` counts those changes). The capture
+    loop reports its frame size, which gives the DPI scale.
+
+    ``monitors()`` is the capture backend's layout: index 0 is the whole
+    virtual desktop, 1.. the monitors, in the same coordinates as the
+    cursor (so a monitor left of the primary one has a negative left).
+    """
+
+    def __init__(self):
+        # Nothing is read from the OS until first use: EncodePool workers
+        # re-import this script and must not touch the display.
+        self.lock = threading.Lock()
+        self.width = self.height = None
+        self.x = self.y = None
+        self.capture_size = None
+        self.layout = None
+        self.generation = 0
+        self.moved_at = 0.0
+        self.used_at = 0.0
+        self.thread = None
+
+    def _ensure_polling(self):
+        self.used_at = time.monotonic()
+        if self.thread is None:
+            if self.width is None:
+                self.width, self.height = pyautogui.size()
+            # Polling was idle, so the cached position may be stale
+            self.x, self.y = pyautogui.position()
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def position(self):
+        with self.lock:
+            self._ensure_polling()
+            return self.x, self.y
+
+    def size(self):
+        with self.lock:
+            self._ensure_polling()
+            return self.width, self.height
+
+    def dpi_scale(self):
+        """Capture pixels per screen pixel (1.0 until a frame was captured)."""
+        with self.lock:
+            if not self.capture_size:
+                return 1.0
+            return self.capture_size[0] / self.width
+
+    def set_capture_size(self, width, height):
+        with self.lock:
+            self.capture_size = (width, height)
+
+    def monitors(self):
+        """[virtual desktop, monitor 1, ...] as dicts of left/top/width/height."""
+        with self.lock:
+            if self.layout is not None:
+                return self.layout
+        # No capture has run yet: ask a backend of our own
+        backend = capture.open_backend(CAPTURE_BACKEND)
+        backend.open()
+        try:
+            self.set_layout(backend.monitors())
+        finally:
+            backend.close()
+        return self.layout
+
+    def set_layout(self, monitors):
+        layout = [{k: int(m[k]) for k in ('left', 'top', 'width', 'height')} for m in monitors]
+        with self.lock:
+            self.layout = layout
+
+    def _moved(self, x, y):
+        """Record a move to (x, y), clamped to the desktop; lock held."""
+        self._ensure_polling()
+        if self.layout:
+            desktop = self.layout[0]
+            left, top = desktop['left'], desktop['top']
+            right, bottom = left + desktop['width'] - 1, top + desktop['height'] - 1
+        else:
+            left, top, right, bottom = 0, 0, self.width - 1, self.height - 1
+        self.x = min(max(left, int(x)), right)
+        self.y = min(max(top, int(y)), bottom)
+        self.moved_at = time.perf_counter()
+
+    def move_to(self, x, y):
+        pyautogui.moveTo(x, y, _pause=False)
+        with self.lock:
+            self._moved(x, y)
+
+    def move_to_normalized(self, nx, ny, monitor=None):
+        """Move to a point given as fractions (0..1) of ``monitor`` (an
+        index into monitors()), or of the primary screen."""
+        if monitor:
+            layout = self.monitors()
+            rect = layout[monitor] if monitor < len(layout) else layout[1]
+        else:
+            width, height = self.size()
+            rect = {'left': 0, 'top': 0, 'width': width, 'height': height}
+        self.move_to(rect['left'] + float(nx) * (rect['width'] - 1),
+                     rect['top'] + float(ny) * (rect['height'] - 1))
+
+    def move_by(self, dx, dy):
+        pyautogui.moveRel(dx, dy, _pause=False)
+        # Read and update in one go: the joystick mover and the input
+        # queue move concurrently, and neither may overwrite the other
+        with self.lock:
+            self._ensure_polling()
+            self._moved(self.x + dx, self.y + dy)
+
+    def refresh(self):
+        started = time.perf_counter()
+        x, y = pyautogui.position()
+        width, height = pyautogui.size()
+        with self.lock:
+            # A move issued while we were asking the OS is newer than its answer
+            if self.moved_at < started:
+                self.x, self.y = x, y
+            if (width, height) != (self.width, self.height):
+                print(f"📱 Screen size changed: {self.width}x{self.height} -> {width}x{height}")
+                self.width, self.height = width, height
+                self.layout = None
+                self.generation += 1
+
+    def _run(self):
+        while True:
+            time.sleep(SCREEN_POLL_INTERVAL)
+            with self.lock:
+                if time.monotonic() - self.used_at > SCREEN_IDLE_SECONDS:
+                    # Nobody is watching or moving: stop until asked again
+                    self.thread = None
+                    return
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"⚠️  Screen poll failed: {e}")
+
+screen = ScreenState()
+
+# --- METRICS ---
+METRICS = metrics.Registry()
+STAGE_SECONDS = METRICS.histogram(
+    'remote_frame_stage_seconds', 'Time spent in each frame pipeline stage.', ('stage',))
+FRAMES_ENCODED = METRICS.counter('remote_frames_encoded_total', 'Full-frame JPEGs encoded.')
+FRAMES_SKIPPED = METRICS.counter('remote_frames_skipped_total', 'Captures skipped because nothing changed.')
+FRAMES_SENT = METRICS.counter('remote_frames_sent_total', 'Frame updates written to viewers.', ('stream',))
+FRAMES_DROPPED = METRICS.counter('remote_frames_dropped_total', 'Published frames a slow viewer never received.')
+BYTES_SENT = METRICS.counter('remote_bytes_sent_total', 'Stream bytes written to viewers.', ('stream',))
+ACTIONS_HANDLED = METRICS.counter('remote_actions_total', 'Input actions applied.', ('action',))
+ACTION_SECONDS = METRICS.histogram('remote_action_seconds', 'Time to apply one input action.', ('action',))
 
 # --- HTML INTERFACE ---
 INTERFACE = """
@@ -91,6 +409,14 @@ INTERFACE = """
             pointer-events: auto;
         }
         
+        .stream-canvas, .stream-video {
+            display: none;
+            width: 100%;
+            height: 100%;
+            object-fit: contain;
+            cursor: crosshair;
+        }
+        
         .fullscreen #viewer {
             height: 100vh;
             width: 100vw;
@@ -339,6 +665,33 @@ INTERFACE = """
             margin: 10px 0;
         }
         
+        /* Cursor drawn by the page from the cursor feed (same look as
+           the server-drawn one in frame_pipeline.draw_cursor) */
+        #cursor-overlay {
+            position: fixed;
+            width: 24px;
+            height: 24px;
+            margin: -12px 0 0 -12px;
+            border: 2px solid rgb(255, 158, 74);
+            border-radius: 50%;
+            display: none;
+            pointer-events: none;
+            z-index: 1500;
+        }
+        #cursor-overlay::after {
+            content: '';
+            position: absolute;
+            left: 8px;
+            top: 8px;
+            width: 4px;
+            height: 4px;
+            border-radius: 50%;
+            background: rgb(255, 158, 74);
+        }
+        #cursor-overlay.clicked {
+            box-shadow: 0 0 0 18px transparent, 0 0 0 21px rgb(0, 255, 0);
+        }
+        
         /* Scroll Indicator */
         #scroll-indicator {
             position: fixed;
@@ -354,9 +707,16 @@ INTERFACE = """
             z-index: 2000;
         }
         
-        /* Status Bar - Hidden */
+        /* Status Bar: connection health and server metrics */
         #status-bar {
-            display: none;
+            padding: 4px 10px 8px;
+            background: #1a1a1a;
+            color: #888;
+            font-size: 11px;
+            text-align: center;
+        }
+        #status-bar.stale {
+            color: #ff6b6b;
         }
         
         .zoom-badge {
@@ -410,6 +770,7 @@ INTERFACE = """
 <body>
     <!-- Scroll Indicator -->
     <div id="scroll-indicator"></div>
+    <div id="cursor-overlay"></div>
     
     <!-- Volume Control -->
     <div id="volume-control">
@@ -445,13 +806,49 @@ INTERFACE = """
         
         <div class="setting-item">
             <span class="setting-label">Stream Quality</span>
-            <select style="width: 100%; padding: 8px; background: #111; color: white; border: 1px solid #444; border-radius: 5px;">
+            <select id="quality-select" onchange="setStreamQuality(this.value)" style="width: 100%; padding: 8px; background: #111; color: white; border: 1px solid #444; border-radius: 5px;">
                 <option value="low">Low (Faster)</option>
                 <option value="medium" selected>Medium</option>
                 <option value="high">High (Slower)</option>
             </select>
         </div>
         
+        <div class="setting-item">
+            <span class="setting-label">Stream Resolution</span>
+            <select id="rendition-select" onchange="setStreamRendition(this.value)" style="width: 100%; padding: 8px; background: #111; color: white; border: 1px solid #444; border-radius: 5px;">
+                <option value="auto" selected>Auto (Fit screen)</option>
+                {% for name in renditions %}
+                <option value="{{ name }}">{{ name }}</option>
+                {% endfor %}
+            </select>
+        </div>
+        
+        {% if monitors|length > 1 %}
+        <div class="setting-item">
+            <span class="setting-label">Monitor</span>
+            <select id="monitor-select" onchange="setStreamMonitor(this.value)" style="width: 100%; padding: 8px; background: #111; color: white; border: 1px solid #444; border-radius: 5px;">
+                {% for m in monitors %}
+                <option value="{{ m.index }}">{{ m.index }}: {{ m.width }}x{{ m.height }}{% if m.primary %} (Primary){% endif %}</option>
+                {% endfor %}
+            </select>
+        </div>
+        {% endif %}
+        
+        <div class="setting-item">
+            <span class="setting-label">Stream Mode</span>
+            <select id="stream-mode" onchange="setStreamMode(this.value)" style="width: 100%; padding: 8px; background: #111; color: white; border: 1px solid #444; border-radius: 5px;">
+                <option value="mjpeg" selected>MJPEG (Compatible)</option>
+                <option value="webp">WebP (Smaller images)</option>
+                {% if video_available %}
+                <option value="h264">H.264 (Lowest bandwidth)</option>
+                {% endif %}
+                {% if sockets_available %}
+                <option value="tiles">Tiles (Changed areas only)</option>
+                <option value="roi">Sharp Cursor Area (ROI)</option>
+                {% endif %}
+            </select>
+        </div>
+        
         <button onclick="resetButtonPositions()" style="width: 100%; margin-top: 20px;">Reset Button Positions</button>
         <button onclick="toggleSettings()" style="width: 100%; margin-top: 10px; background: #ff4444;">Close</button>
     </div>
@@ -459,12 +856,14 @@ INTERFACE = """
     <!-- Normal Mode -->
     <div id="normal-mode">
         <div id="viewer">
-            <img id="stream" src="{{ url_for('video_feed') }}">
+            <img id="stream">
+            <canvas id="stream-canvas" class="stream-canvas"></canvas>
+            <video id="stream-video" class="stream-video" muted autoplay playsinline></video>
         </div>
         <div id="joystick-zone"></div>
         <div class="typing">
             <input type="text" id="kb" placeholder="Type here... (empty = Enter)" onkeypress="if(event.key==='Enter')sendText()">
-            <button onclick="sendText()">SEND</button>
+            <button id="send-btn" onclick="typingBusy ? sendAction('type_cancel') : sendText()">SEND</button>
         </div>
         <div class="controls">
             <button onclick="doAction('click')">🖱️ LEFT</button>
@@ -480,7 +879,7 @@ INTERFACE = """
             <button onclick="doAction('zoom_in')">🔍 ZOOM+</button>
             
             <button onclick="doAction('zoom_out')">🔍 ZOOM-</button>
-            <button onclick="doAction('zoom_reset')">↺ RESET</button>
+            <button onclick="doAction('zoom_reset')">↺ RESET <span class="zoom-badge" id="zoom-badge">1x</span></button>
             <button onclick="toggleFullscreen()">⛶ FULL</button>
             
             <button onclick="toggleSettings()">⚙️ SETTINGS</button>
@@ -488,12 +887,15 @@ INTERFACE = """
         <div class="controls" style="grid-template-columns: 1fr;">
             <button onclick="location.href='/logout'" style="background: linear-gradient(135deg, #ff4444 0%, #cc0000 100%);">🔒 LOCK</button>
         </div>
+        <div id="status-bar"></div>
     </div>
 
     <!-- Fullscreen Mode -->
     <div id="fullscreen-mode">
         <div id="viewer" class="fs-viewer">
-            <img id="stream-fs" src="{{ url_for('video_feed') }}">
+            <img id="stream-fs">
+            <canvas id="stream-fs-canvas" class="stream-canvas"></canvas>
+            <video id="stream-fs-video" class="stream-video" muted autoplay playsinline></video>
         </div>
         <div id="joystick-zone-fs"></div>
         
@@ -682,8 +1084,117 @@ INTERFACE = """
         // Managers for both joysticks
         let normalManager = null;
         let fullscreenManager = null;
+
+        // ---------- INPUT CHANNEL ----------
+        const SOCKETS_AVAILABLE = {{ 'true' if sockets_available else 'false' }};
+        // Events go out as sequenced JSON lines over one WebSocket, batched
+        // per animation frame; plain /action requests are the fallback.
+        // /action and /ping authenticate with a short-lived token instead
+        // of the session cookie; it is renewed well before it expires.
+        let actionToken = '{{ action_token }}';
+        function renewActionToken() {
+            return fetch('/action_token').then(r => r.ok ? r.json() : null).then(data => {
+                if (data && data.token) actionToken = data.token;
+            }).catch(() => {});
+        }
+        setInterval(renewActionToken, {{ (action_token_seconds * 500)|int }});
+        let inputSocket = null;
+        let inputSeq = 0;
+        let inputBatch = [];
+        let inputRtt = null;
+        function openInputSocket() {
+            if (!SOCKETS_AVAILABLE) return;
+            const proto = location.protocol === 'https:' ? 'wss' : 'ws';
+            inputSocket = new WebSocket(`${proto}://${location.host}/input?cursor=1`);
+            inputSocket.onmessage = e => {
+                const msg = JSON.parse(e.data);
+                if (msg.cursor) updateCursor(msg.cursor);
+                else if (msg.t) inputRtt = Date.now() - msg.t;
+            };
+            // A visibility change made while the socket was down may have
+            // been lost; the server learns the current state on every open
+            inputSocket.onopen = () => sendVisibility();
+            inputSocket.onclose = () => {
+                inputSocket = null;
+                setTimeout(openInputSocket, 1000);
+            };
+        }
+        function flushInput() {
+            if (inputBatch.length === 0) return;
+            if (!inputSocket || inputSocket.readyState !== WebSocket.OPEN) {
+                const events = inputBatch;
+                inputBatch = [];
+                events.forEach(ev => sendAction(ev.type, ev));
+                return;
+            }
+            const lines = inputBatch.map(ev => JSON.stringify(ev)).join('\\n');
+            inputBatch = [];
+            inputSocket.send(lines);
+        }
+        function sendAction(type, params = {}) {
+            if (inputSocket && inputSocket.readyState === WebSocket.OPEN) {
+                if (inputBatch.length === 0) requestAnimationFrame(flushInput);
+                inputBatch.push(Object.assign({seq: ++inputSeq, t: Date.now(), type: type}, params));
+                return;
+            }
+            const query = new URLSearchParams(Object.assign({type: type}, params));
+            fetch(`/action?${query}`, {headers: {'{{ action_token_header }}': actionToken}})
+                .then(r => { if (r.status === 401) renewActionToken(); });
+        }
+        // Hidden tabs suspend requestAnimationFrame, so an event sent as
+        // the page hides goes out at once, with anything still batched;
+        // a keepalive fetch outlives the page being frozen or closed.
+        function sendActionNow(type, params = {}) {
+            if (inputSocket && inputSocket.readyState === WebSocket.OPEN) {
+                inputBatch.push(Object.assign({seq: ++inputSeq, t: Date.now(), type: type}, params));
+                flushInput();
+                return;
+            }
+            const query = new URLSearchParams(Object.assign({type: type}, params));
+            const post = () => fetch(`/action?${query}`,
+                {headers: {'{{ action_token_header }}': actionToken}, keepalive: true});
+            // A phone waking from a long sleep holds an expired token
+            post().then(r => { if (r.status === 401) renewActionToken().then(post); }).catch(() => {});
+        }
+        function sendVisibility() {
+            sendActionNow('visibility', {page: PAGE_ID, visible: !document.hidden});
+        }
+        openInputSocket();
         
         // ---------- JOYSTICK ----------
+        // The joystick vector is sent when it changes, and resent every
+        // 250 ms while the stick is held (nipplejs stops firing 'move'
+        // when the finger holds still) so the server's watchdog keeps it
+        // alive; the server integrates it into smooth cursor motion until
+        // joy_stop.
+        function bindJoystick(manager) {
+            let lastVel = {x: 0, y: 0};
+            let refresh = null;
+            function stopRefresh() {
+                clearInterval(refresh);
+                refresh = null;
+            }
+            manager.on('move', function (evt, data) {
+                if (gyroEnabled || !data.direction) return;
+                let speed = data.distance / 2;
+                let angle = data.angle.radian;
+                let vx = Math.cos(angle) * speed * (sensitivity / 5);
+                let vy = -Math.sin(angle) * speed * (sensitivity / 5);
+                if (Math.abs(vx - lastVel.x) > 0.5 || Math.abs(vy - lastVel.y) > 0.5) {
+                    lastVel = {x: vx, y: vy};
+                    sendAction('joy_vel', lastVel);
+                }
+                if (!refresh) {
+                    refresh = setInterval(() => sendAction('joy_vel', lastVel), 250);
+                }
+            });
+            manager.on('end', function () {
+                stopRefresh();
+                lastVel = {x: 0, y: 0};
+                sendAction('joy_stop');
+            });
+            manager.on('destroyed', stopRefresh);
+        }
         function initNormalJoystick() {
             if (normalManager) normalManager.destroy();
             normalManager = nipplejs.create({
@@ -693,19 +1204,7 @@ INTERFACE = """
                 color: '#4a9eff',
                 size: 120
             });
-            let lastMove = 0;
-            normalManager.on('move', function (evt, data) {
-                if (gyroEnabled) return;
-                let now = Date.now();
-                if (data.direction && now - lastMove > 40) {
-                    lastMove = now;
-                    let speed = data.distance / 2;
-                    let angle = data.angle.radian;
-                    let vx = Math.cos(angle) * speed * (sensitivity / 5);
-                    let vy = -Math.sin(angle) * speed * (sensitivity / 5);
-                    fetch(`/action?type=move_joy&x=${vx}&y=${vy}`);
-                }
-            });
+            bindJoystick(normalManager);
         }
         function initFullscreenJoystick() {
             if (fullscreenManager) fullscreenManager.destroy();
@@ -716,19 +1215,7 @@ INTERFACE = """
                 color: '#4a9eff',
                 size: 140
             });
-            let lastMove = 0;
-            fullscreenManager.on('move', function (evt, data) {
-                if (gyroEnabled) return;
-                let now = Date.now();
-                if (data.direction && now - lastMove > 40) {
-                    lastMove = now;
-                    let speed = data.distance / 2;
-                    let angle = data.angle.radian;
-                    let vx = Math.cos(angle) * speed * (sensitivity / 5);
-                    let vy = -Math.sin(angle) * speed * (sensitivity / 5);
-                    fetch(`/action?type=move_joy&x=${vx}&y=${vy}`);
-                }
-            });
+            bindJoystick(fullscreenManager);
         }
         initNormalJoystick();
         initFullscreenJoystick();
@@ -771,7 +1258,7 @@ INTERFACE = """
             const deltaX = (gamma - lastOrientation.gamma) * sensitivity * 2;
             const deltaY = (beta - lastOrientation.beta) * sensitivity * 2;
             if (Math.abs(deltaX) > 0.5 || Math.abs(deltaY) > 0.5) {
-                fetch(`/action?type=move_joy&x=${deltaX}&y=${deltaY}`);
+                sendAction('move_joy', {x: deltaX, y: deltaY});
             }
             lastOrientation = { beta, gamma };
         }
@@ -790,15 +1277,63 @@ INTERFACE = """
         document.getElementById('volume-slider').addEventListener('input', function(e) {
             const val = e.target.value;
             document.getElementById('volume-value').textContent = val + '%';
-            fetch(`/action?type=volume&val=${val}`);
+            sendAction('volume', {val: val});
         });
-        fetch('/get_volume').then(r => r.json()).then(data => {
-            if (data.volume !== null) {
-                const vol = Math.round(data.volume * 100);
-                document.getElementById('volume-slider').value = vol;
-                document.getElementById('volume-value').textContent = vol + '%';
+
+        // ---------- SERVER STATE ----------
+        // One event stream instead of polling /get_volume and /get_zoom:
+        // the server pushes whatever changed (coalesced), so every open
+        // tab shows the same zoom, volume and held keys.
+        let serverMetrics = null;
+        let lastHealth = 0;
+        function applyState(changes) {
+            if ('volume' in changes && changes.volume !== null) {
+                const slider = document.getElementById('volume-slider');
+                if (document.activeElement !== slider) {  // Don't fight a drag in progress
+                    const vol = Math.round(changes.volume * 100);
+                    slider.value = vol;
+                    document.getElementById('volume-value').textContent = vol + '%';
+                }
             }
-        });
+            if ('zoom' in changes) {
+                document.getElementById('zoom-badge').textContent = changes.zoom + 'x';
+            }
+            if ('held_keys' in changes) {
+                heldKeys = new Set(changes.held_keys);
+                updateVirtualKeyboardDisplay();
+            }
+            if ('metrics' in changes) {
+                serverMetrics = changes.metrics;
+                renderStatus();
+            }
+            if ('typing' in changes) {
+                showTyping(changes.typing);
+            }
+        }
+        const stateStream = new EventSource('/state_stream');
+        stateStream.onmessage = e => { lastHealth = Date.now(); applyState(JSON.parse(e.data)); };
+        stateStream.addEventListener('health', () => { lastHealth = Date.now(); });
+
+        // ---------- STATUS BAR ----------
+        // The state stream sends something at least every keepalive
+        // interval; missing two in a row means the link to the server is
+        // down even if the picture still shows the last frame.
+        const STATE_STALE_MS = {{ (keepalive_interval * 2000)|int }};
+        function renderStatus() {
+            const bar = document.getElementById('status-bar');
+            const stale = !lastHealth || Date.now() - lastHealth > STATE_STALE_MS;
+            const parts = [stale ? '● reconnecting' : '● connected'];
+            if (serverMetrics) {
+                parts.push(`${serverMetrics.viewers} viewer${serverMetrics.viewers === 1 ? '' : 's'}`);
+                parts.push(serverMetrics.capturing.length
+                    ? `capturing monitor ${serverMetrics.capturing.join(', ')}` : 'capture paused');
+                parts.push(`${serverMetrics.skipped_frames} unchanged frames skipped`);
+            }
+            if (inputRtt !== null) parts.push(`input ${inputRtt} ms`);
+            bar.textContent = parts.join(' · ');
+            bar.classList.toggle('stale', stale);
+        }
+        setInterval(renderStatus, 1000);
 
         // ---------- DRAG ----------
         function toggleDrag() {
@@ -808,7 +1343,7 @@ INTERFACE = """
                 btn.innerText = isDragging ? "✋ DRAG ON" : "✋ DRAG OFF";
                 btn.classList.toggle('active');
             });
-            fetch(`/action?type=${isDragging ? 'drag_start' : 'drag_end'}`);
+            sendAction(isDragging ? 'drag_start' : 'drag_end');
         }
 
         // ---------- RIGHT CLICK DRAG ----------
@@ -819,7 +1354,7 @@ INTERFACE = """
                 btn.innerText = isRightDragging ? "✋ R-DRAG ON" : "✋ R-DRAG OFF";
                 btn.classList.toggle('active');
             });
-            fetch(`/action?type=${isRightDragging ? 'right_drag_start' : 'right_drag_end'}`);
+            sendAction(isRightDragging ? 'right_drag_start' : 'right_drag_end');
         }
 
         // ---------- FULLSCREEN ----------
@@ -831,6 +1366,7 @@ INTERFACE = """
                 if (document.documentElement.requestFullscreen) {
                     document.documentElement.requestFullscreen();
                 }
+                reloadStreams();
             } else {
                 exitFullscreen();
             }
@@ -838,6 +1374,7 @@ INTERFACE = """
         function exitFullscreen() {
             isFullscreen = false;
             document.body.classList.remove('fullscreen');
+            reloadStreams();
             if (document.exitFullscreen) {
                 document.exitFullscreen();
             } else if (document.webkitExitFullscreen) {
@@ -908,46 +1445,359 @@ INTERFACE = """
                     if (heldKeys.has(key)) {
                         // Release this key
                         heldKeys.delete(key);
-                        fetch(`/action?type=key_up&key=${encodeURIComponent(key)}`);
+                        sendAction('key_up', {key: key});
                     } else {
                         // Hold this key
                         heldKeys.add(key);
-                        fetch(`/action?type=key_down&key=${encodeURIComponent(key)}`);
+                        sendAction('key_down', {key: key});
                     }
                     updateVirtualKeyboardDisplay();
                 } else {
                     // Normal key press (visual feedback)
                     e.target.classList.add('active');
                     setTimeout(() => e.target.classList.remove('active'), 150);
-                    fetch(`/action?type=key&key=${encodeURIComponent(key)}`);
+                    sendAction('key', {key: key});
                 }
             }
         });
 
         // ---------- SEND TEXT ----------
+        // Long text is typed in the background; while it is, SEND shows
+        // the progress and cancels the rest when pressed.
+        let typingBusy = false;
+        function showTyping(job) {
+            typingBusy = job.state === 'typing';
+            document.getElementById('send-btn').textContent = typingBusy
+                ? '✖ ' + Math.floor(100 * job.done / Math.max(1, job.total)) + '%'
+                : 'SEND';
+        }
         function sendText() {
             const input = document.getElementById('kb');
             const text = input.value.trim();
             if (text === "") {
-                fetch(`/action?type=enter`);
+                sendAction('enter');
             } else {
-                fetch(`/action?type=type&val=${encodeURIComponent(text)}`);
+                sendAction('type', {val: text});
             }
             input.value = '';
         }
 
         // ---------- GENERAL ACTION ----------
         function doAction(type) {
-            fetch(`/action?type=${type}`);
+            sendAction(type);
+        }
+
+        // ---------- STREAM QUALITY ----------
+        // The server adapts each stream to the link; this only sets the
+        // best quality it may use.
+        let streamQuality = localStorage.getItem('streamQuality') || 'medium';
+        document.getElementById('quality-select').value = streamQuality;
+        // Resolution: a fixed rendition, or 'auto' to let the server pick
+        // one from the size the image is shown at.
+        let streamRendition = localStorage.getItem('streamRendition') || 'auto';
+        const renditionSelect = document.getElementById('rendition-select');
+        if (![...renditionSelect.options].some(o => o.value === streamRendition)) streamRendition = 'auto';
+        renditionSelect.value = streamRendition;
+        // Monitor: which one the streams show and clicks land on
+        const monitorCount = {{ monitors|length }};
+        let streamMonitor = localStorage.getItem('streamMonitor') || '1';
+        if (!(Number(streamMonitor) >= 1 && Number(streamMonitor) <= monitorCount)) streamMonitor = '1';
+        const monitorSelect = document.getElementById('monitor-select');
+        if (monitorSelect) monitorSelect.value = streamMonitor;
+        // Streams carry this page's id so the server can pause them while
+        // the page is hidden (see the visibility reports below).
+        const PAGE_ID = Math.random().toString(36).slice(2, 12);
+        function videoFeedUrl(id) {
+            const params = new URLSearchParams({quality: streamQuality, rendition: streamRendition,
+                                                monitor: streamMonitor, page: PAGE_ID});
+            // With the input socket the page draws the cursor itself
+            if (SOCKETS_AVAILABLE) params.set('cursor', 'client');
+            if (streamRendition === 'auto') {
+                // The fullscreen image is hidden until used: size it by the screen
+                const img = document.getElementById(id);
+                const fs = id === 'stream-fs' || !img.clientWidth;
+                params.set('vw', fs ? screen.width : img.clientWidth);
+                params.set('vh', fs ? screen.height : (img.clientHeight || window.innerHeight));
+                params.set('dpr', window.devicePixelRatio || 1);
+            }
+            if (streamMode === 'h264') return `{{ url_for('video_mp4') }}?${params}`;
+            if (streamMode === 'webp') params.set('codec', 'webp');
+            return `{{ url_for('video_feed') }}?${params}`;
+        }
+        // Only the view on screen streams; the other one is closed.
+        function visibleStreamId() {
+            return isFullscreen ? 'stream-fs' : 'stream';
+        }
+        function reloadStreams() {
+            if (streamMode === 'mjpeg' || streamMode === 'webp') {
+                ['stream', 'stream-fs'].forEach(id => {
+                    const img = document.getElementById(id);
+                    if (id === visibleStreamId() && !document.hidden) img.src = videoFeedUrl(id);
+                    else img.removeAttribute('src');
+                });
+            } else if (streamMode === 'h264') {
+                closeVideoStreams();
+                if (!document.hidden) openVideoStream(visibleStreamId());
+            }
+            drawCursorOverlay();
+        }
+        function setStreamQuality(quality) {
+            streamQuality = quality;
+            localStorage.setItem('streamQuality', quality);
+            reloadStreams();
+        }
+        function setStreamRendition(rendition) {
+            streamRendition = rendition;
+            localStorage.setItem('streamRendition', rendition);
+            reloadStreams();
+        }
+        function setStreamMonitor(monitor) {
+            streamMonitor = monitor;
+            localStorage.setItem('streamMonitor', monitor);
+            setStreamMode(streamMode);  // Reopens tile sockets too
+        }
+
+        // ---------- STREAM MODE ----------
+        // MJPEG and WebP are multipart images in the <img> elements, tiles
+        // are drawn onto the canvases, H.264 plays in the <video> elements.
+        let streamMode = 'mjpeg';
+        function setStreamMode(mode) {
+            if (mode === 'h264' && !(window.MediaSource && MediaSource.isTypeSupported(H264_MIME))) {
+                mode = 'mjpeg';  // No MSE/H.264 in this browser: keep MJPEG
+            }
+            streamMode = mode;
+            localStorage.setItem('streamMode', mode);
+            const modeSelect = document.getElementById('stream-mode');
+            if (modeSelect.value !== mode) modeSelect.value = mode;
+            const images = mode === 'mjpeg' || mode === 'webp';
+            ['stream', 'stream-fs'].forEach(id => {
+                const img = document.getElementById(id);
+                img.style.display = images ? '' : 'none';
+                if (!images) img.removeAttribute('src');
+            });
+            const canvases = mode === 'tiles' || mode === 'roi';
+            document.querySelectorAll('.stream-canvas').forEach(c => c.style.display = canvases ? 'block' : 'none');
+            document.querySelectorAll('.stream-video').forEach(v => v.style.display = mode === 'h264' ? 'block' : 'none');
+            if (tileSocket) {
+                tileSocket.onclose = null;
+                tileSocket.close();
+                tileSocket = null;
+            }
+            if (canvases && !document.hidden) openTileSocket();
+            if (mode !== 'h264') closeVideoStreams();
+            reloadStreams();
+        }
+
+        // ---------- CURSOR OVERLAY ----------
+        // The server sends the cursor position plus, per monitor, the
+        // screen rectangle the frames show; the cursor is drawn over the
+        // visible stream unless the frames already contain it.
+        let lastCursor = null;
+        function updateCursor(cursor) {
+            lastCursor = cursor;
+            drawCursorOverlay();
+        }
+        function streamElement() {
+            const id = visibleStreamId();
+            if (streamMode === 'h264') return document.getElementById(id + '-video');
+            if (streamMode === 'tiles' || streamMode === 'roi') return document.getElementById(id + '-canvas');
+            return document.getElementById(id);
+        }
+        // The stream elements use object-fit: contain, so the picture is
+        // letterboxed inside the element box; this is the picture's box.
+        function contentRect(el) {
+            const box = el.getBoundingClientRect();
+            const natW = el.naturalWidth || el.videoWidth || el.width;
+            const natH = el.naturalHeight || el.videoHeight || el.height;
+            if (!natW || !natH || !box.width || !box.height) return box;
+            const scale = Math.min(box.width / natW, box.height / natH);
+            const width = natW * scale, height = natH * scale;
+            return {left: box.left + (box.width - width) / 2, top: box.top + (box.height - height) / 2,
+                    width: width, height: height};
+        }
+        function drawCursorOverlay() {
+            const overlay = document.getElementById('cursor-overlay');
+            const view = lastCursor && lastCursor.views[streamMonitor];
+            const rect = contentRect(streamElement());
+            let nx = -1, ny = -1;
+            if (view && !view.drawn && streamMode !== 'roi' && !document.hidden) {
+                const [left, top, width, height] = view.rect;
+                nx = (lastCursor.x - left) / width;
+                ny = (lastCursor.y - top) / height;
+            }
+            if (nx < 0 || nx > 1 || ny < 0 || ny > 1 || !rect.width) {
+                overlay.style.display = 'none';
+                return;
+            }
+            overlay.style.left = (rect.left + nx * rect.width) + 'px';
+            overlay.style.top = (rect.top + ny * rect.height) + 'px';
+            overlay.classList.toggle('clicked', lastCursor.click);
+            overlay.style.display = 'block';
+        }
+        window.addEventListener('resize', drawCursorOverlay);
+
+        // ---------- PAGE VISIBILITY ----------
+        // A background tab or locked phone drops its streams and tells
+        // the server, which pauses capture once nobody is looking.
+        document.addEventListener('visibilitychange', () => {
+            sendVisibility();
+            if (document.hidden) {
+                ['stream', 'stream-fs'].forEach(id => document.getElementById(id).removeAttribute('src'));
+                closeVideoStreams();
+                if (tileSocket) {
+                    tileSocket.onclose = null;
+                    tileSocket.close();
+                    tileSocket = null;
+                }
+            } else {
+                setStreamMode(streamMode);
+            }
+        });
+
+        // ---------- H.264 STREAM ----------
+        // Fragmented MP4 read from a streaming fetch and fed to Media
+        // Source Extensions; playback is kept at the live edge.
+        const H264_MIME = '{{ video_mime|safe }}';
+        const videoStreams = {};
+        function openVideoStream(id) {
+            const video = document.getElementById(id + '-video');
+            const controller = new AbortController();
+            const source = new MediaSource();
+            videoStreams[id] = controller;
+            video.src = URL.createObjectURL(source);
+            source.addEventListener('sourceopen', async () => {
+                URL.revokeObjectURL(video.src);
+                const buffer = source.addSourceBuffer(H264_MIME);
+                const queue = [];
+                const pump = () => {
+                    if (!buffer.updating && queue.length) buffer.appendBuffer(queue.shift());
+                };
+                buffer.addEventListener('updateend', () => {
+                    const ranges = video.buffered;
+                    if (ranges.length) {
+                        const start = ranges.start(ranges.length - 1);
+                        const end = ranges.end(ranges.length - 1);
+                        if (video.currentTime < start || end - video.currentTime > 0.5) {
+                            video.currentTime = Math.max(start, end - 0.05);
+                        }
+                        if (!buffer.updating && video.currentTime - ranges.start(0) > 30) {
+                            buffer.remove(0, video.currentTime - 10);
+                            return;
+                        }
+                    }
+                    pump();
+                });
+                try {
+                    const response = await fetch(videoFeedUrl(id), {signal: controller.signal});
+                    if (response.status === 503) {
+                        setStreamMode('mjpeg');  // Server has no H.264 encoder
+                        return;
+                    }
+                    const reader = response.body.getReader();
+                    while (true) {
+                        const {value, done} = await reader.read();
+                        if (done) break;
+                        queue.push(value);
+                        pump();
+                        video.play().catch(() => {});
+                    }
+                } catch (err) {
+                    if (controller.signal.aborted) return;
+                    console.error(err);
+                }
+                if (streamMode === 'h264' && videoStreams[id] === controller && !document.hidden) {
+                    setTimeout(() => { if (videoStreams[id] === controller) openVideoStream(id); }, 1000);
+                }
+            }, {once: true});
+        }
+        function closeVideoStreams() {
+            Object.keys(videoStreams).forEach(id => {
+                videoStreams[id].abort();
+                delete videoStreams[id];
+                document.getElementById(id + '-video').removeAttribute('src');
+            });
+        }
+
+        // ---------- TILE STREAM ----------
+        // Changed 64x64 tiles arrive over a binary WebSocket and are drawn
+        // onto the canvases in place of the MJPEG <img> elements. In ROI
+        // mode each message is a soft background scaled over the whole
+        // canvas plus sharp patches, all at screen resolution.
+        let tileSocket = null;
+        let tileDrawQueue = Promise.resolve();
+        function openTileSocket() {
+            if (tileSocket) return;
+            const proto = location.protocol === 'https:' ? 'wss' : 'ws';
+            tileSocket = new WebSocket(`${proto}://${location.host}/tiles?mode=${streamMode}&monitor=${streamMonitor}&page=${PAGE_ID}&cursor=client`);
+            tileSocket.binaryType = 'arraybuffer';
+            tileSocket.onmessage = e => drawTiles(e.data);
+            tileSocket.onclose = () => {
+                tileSocket = null;
+                if ((streamMode === 'tiles' || streamMode === 'roi') && !document.hidden) setTimeout(openTileSocket, 1000);
+            };
+        }
+        // ROI updates: MSG_ROI starts with a new background, MSG_ROI_PATCHES
+        // only has patches to draw over the last one.
+        const MSG_ROI = {{ msg_roi }}, MSG_ROI_PATCHES = {{ msg_roi_patches }};
+        let roiBackground = null;
+        function drawTiles(buf) {
+            const view = new DataView(buf);
+            const kind = view.getUint8(0);
+            const w = view.getUint16(1, true), h = view.getUint16(3, true);
+            const count = view.getUint16(5, true);
+            const tiles = [];
+            let off = 7;
+            for (let i = 0; i < count; i++) {
+                const len = view.getUint32(off + 8, true);
+                tiles.push({
+                    x: view.getUint16(off, true),
+                    y: view.getUint16(off + 2, true),
+                    w: view.getUint16(off + 4, true),
+                    h: view.getUint16(off + 6, true),
+                    blob: new Blob([new Uint8Array(buf, off + 12, len)], {type: 'image/jpeg'})
+                });
+                off += 12 + len;
+            }
+            // Decode in parallel but paint updates strictly in arrival order
+            const decoded = Promise.all(tiles.map(t => createImageBitmap(t.blob)));
+            tileDrawQueue = tileDrawQueue.then(() => decoded).then(bitmaps => {
+                bitmaps = bitmaps.map((bmp, i) => Object.assign({bmp: bmp}, tiles[i]));
+                if (kind === MSG_ROI) {
+                    if (roiBackground) roiBackground.bmp.close();
+                    roiBackground = bitmaps[0];
+                } else if (kind === MSG_ROI_PATCHES) {
+                    // Paint over the old patches with the background first
+                    if (!roiBackground) {
+                        bitmaps.forEach(t => t.bmp.close());
+                        return;
+                    }
+                    bitmaps.unshift(roiBackground);
+                }
+                document.querySelectorAll('.stream-canvas').forEach(canvas => {
+                    if (canvas.width !== w || canvas.height !== h) {
+                        canvas.width = w;
+                        canvas.height = h;
+                    }
+                    const ctx = canvas.getContext('2d');
+                    bitmaps.forEach(t => ctx.drawImage(t.bmp, t.x, t.y, t.w, t.h));
+                });
+                bitmaps.forEach(t => { if (t !== roiBackground) t.bmp.close(); });
+            }).catch(console.error);
         }
+        // Open the streams in this viewer's mode, quality and resolution
+        const savedMode = localStorage.getItem('streamMode') || 'mjpeg';
+        const modeOffered = [...document.getElementById('stream-mode').options].some(o => o.value === savedMode);
+        setStreamMode(modeOffered ? savedMode : 'mjpeg');
 
         // ---------- SCREEN CLICK (NORMAL MODE) ----------
         document.getElementById('viewer').addEventListener('click', function(e) {
-            if (e.target.tagName === 'IMG') {
+            if (['IMG', 'CANVAS', 'VIDEO'].includes(e.target.tagName)) {
                 const rect = e.target.getBoundingClientRect();
-                const x = (e.clientX - rect.left) / rect.width * {{ screen_w }};
-                const y = (e.clientY - rect.top) / rect.height * {{ screen_h }};
-                fetch(`/action?type=move_abs&x=${x}&y=${y}`);
+                sendAction('move_abs', {
+                    nx: (e.clientX - rect.left) / rect.width,
+                    ny: (e.clientY - rect.top) / rect.height,
+                    monitor: streamMonitor
+                });
             }
         });
         
@@ -955,11 +1805,15 @@ INTERFACE = """
         document.addEventListener('click', function(e) {
             if (!isFullscreen) return;
             const streamFs = document.getElementById('stream-fs');
-            if (e.target === streamFs) {
-                const rect = streamFs.getBoundingClientRect();
-                const x = (e.clientX - rect.left) / rect.width * {{ screen_w }};
-                const y = (e.clientY - rect.top) / rect.height * {{ screen_h }};
-                fetch(`/action?type=move_abs&x=${x}&y=${y}`);
+            const canvasFs = document.getElementById('stream-fs-canvas');
+            const videoFs = document.getElementById('stream-fs-video');
+            if (e.target === streamFs || e.target === canvasFs || e.target === videoFs) {
+                const rect = e.target.getBoundingClientRect();
+                sendAction('move_abs', {
+                    nx: (e.clientX - rect.left) / rect.width,
+                    ny: (e.clientY - rect.top) / rect.height,
+                    monitor: streamMonitor
+                });
             }
         });
 
@@ -970,7 +1824,7 @@ INTERFACE = """
             const indicator = document.getElementById('scroll-indicator');
             indicator.textContent = e.deltaY > 0 ? '↓ Scroll Down' : '↑ Scroll Up';
             indicator.style.display = 'block';
-            fetch(`/action?type=${direction}`);
+            sendAction(direction);
             setTimeout(() => indicator.style.display = 'none', 500);
         }, { passive: false });
 
@@ -994,7 +1848,7 @@ INTERFACE = """
                         const indicator = document.getElementById('scroll-indicator');
                         indicator.textContent = delta > 0 ? '↑ Scroll Up' : '↓ Scroll Down';
                         indicator.style.display = 'block';
-                        fetch(`/action?type=${direction}`);
+                        sendAction(direction);
                         touchStartY = currentY;
                         setTimeout(() => indicator.style.display = 'none', 500);
                     }
@@ -1211,6 +2065,78 @@ INTERFACE = """
 </html>
 """
 
+# --- CAPABILITY TOKENS ---
+class TokenStore:
+    """Bearer tokens for the high-rate input endpoints.
+
+    Checking one is a dict lookup and a clock compare, where the session
+    cookie costs an HMAC check and a JSON decode on every request. Tokens
+    are issued to a logged-in session, never outlive it (``issue`` takes
+    the session's data and caps the token at its expiry) and are revoked
+    with that session's ``sid`` on logout.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tokens = {}
+
+    def issue(self, session_data, seconds=ACTION_TOKEN_SECONDS):
+        """A token for ``session_data`` (a Flask session or a decoded
+        cookie) valid for ``seconds``, or until the session ends if sooner
+        or if ``seconds`` is None."""
+        token = secrets.token_urlsafe(18)
+        now = time.time()
+        expires = session_expiry(session_data)
+        if seconds is not None:
+            expires = min(expires, now + seconds)
+        with self.lock:
+            # Issuing is rare, so expired tokens are dropped here
+            self.tokens = {t: e for t, e in self.tokens.items() if e[0] > now}
+            self.tokens[token] = (expires, session_data.get('sid'))
+        return token
+
+    def check(self, token):
+        entry = self.tokens.get(token) if token else None
+        return entry is not None and entry[0] > time.time()
+
+    def discard(self, token):
+        with self.lock:
+            self.tokens.pop(token, None)
+
+    def revoke(self, sid):
+        with self.lock:
+            self.tokens = {t: e for t, e in self.tokens.items() if e[1] != sid}
+
+action_tokens = TokenStore()
+
+def session_expiry(session_data):
+    """When a session ends: SESSION_LIFETIME after its login."""
+    # Sessions from before login times were recorded count from now
+    login_at = session_data.get('login_at') or time.time()
+    return login_at + SESSION_LIFETIME.total_seconds()
+
+def action_authorized():
+    """Token fast path; the session cookie is only decoded without one."""
+    return action_tokens.check(request.headers.get(ACTION_TOKEN_HEADER)) or session.get('auth')
+
+class InputSessionInterface(SecureCookieSessionInterface):
+    """Leaves the session cookie alone on token-authenticated input requests.
+
+    Flask opens the session before the view runs, so without this the
+    token fast path would still pay for the cookie's HMAC check and JSON
+    decode on every /action and /ping.
+    """
+
+    token_paths = ('/action', '/ping')
+
+    def open_session(self, app, request):
+        if (request.path in self.token_paths
+                and action_tokens.check(request.headers.get(ACTION_TOKEN_HEADER))):
+            return self.make_null_session(app)
+        return super().open_session(app, request)
+
+app.session_interface = InputSessionInterface()
+
 # --- ROUTES ---
 @app.route('/', methods=['GET', 'POST'])
 def login():
@@ -1218,8 +2144,9 @@ def login():
         pw = request.form.get('p')
         if pw and check_password_hash(PASSWORD_HASH, pw):
             session['auth'] = True
+            session['sid'] = secrets.token_hex(8)
+            session['login_at'] = time.time()
             session.permanent = True
-            app.permanent_session_lifetime = timedelta(hours=2)
             return redirect(url_for('remote'))
         else:
             return render_template_string("""
@@ -1253,16 +2180,34 @@ def login():
 def remote():
     if not session.get('auth'): 
         return redirect(url_for('login'))
-    return render_template_string(INTERFACE, screen_w=SCREEN_W, screen_h=SCREEN_H)
+    return render_template_string(INTERFACE, monitors=monitor_list(),
+                                  sockets_available=sock is not None,
+                                  video_available=video_codec.av is not None,
+                                  video_mime=video_codec.mime_type(
+                                      *max(RENDITIONS.values(), key=lambda size: size[1])),
+                                  renditions=available_renditions(),
+                                  msg_roi=MSG_ROI, msg_roi_patches=MSG_ROI_PATCHES,
+                                  action_token=action_tokens.issue(session),
+                                  action_token_seconds=ACTION_TOKEN_SECONDS,
+                                  action_token_header=ACTION_TOKEN_HEADER,
+                                  keepalive_interval=KEEPALIVE_INTERVAL)
 
 @app.route('/logout')
 def logout():
+    action_tokens.revoke(session.get('sid'))
     session.clear()
     return redirect(url_for('login'))
 
+@app.route('/action_token')
+def action_token():
+    if not session.get('auth'):
+        return jsonify({'token': None}), 401
+    return jsonify({'token': action_tokens.issue(session),
+                    'expires_in': ACTION_TOKEN_SECONDS})
+
 @app.route('/ping')
 def ping():
-    if not session.get('auth'):
+    if not action_authorized():
         return "Unauthorized", 401
     return "OK"
 
@@ -1270,13 +2215,13 @@ def ping():
 def get_volume():
     if not session.get('auth'):
         return jsonify({'volume': None}), 401
-    if audio_available and volume:
-        try:
-            current_vol = volume.GetMasterVolumeLevelScalar()
-            return jsonify({'volume': current_vol})
-        except:
-            pass
-    return jsonify({'volume': None})
+    return jsonify({'volume': volume_service.level})
+
+@app.route('/monitors')
+def monitors():
+    if not session.get('auth'):
+        return jsonify({'monitors': []}), 401
+    return jsonify({'monitors': monitor_list()})
 
 @app.route('/get_zoom')
 def get_zoom():
@@ -1284,108 +2229,1481 @@ def get_zoom():
         return jsonify({'zoom': 1.0}), 401
     return jsonify({'zoom': zoom_factor})
 
+# --- SHARED CAPTURE ENGINE ---
+PART_HEADERS = {
+    'jpeg': b'--frame\r\nContent-Type: image/jpeg\r\n\r\n',
+    'webp': b'--frame\r\nContent-Type: image/webp\r\n\r\n',
+}
+
+class FrameProducer:
+    """One capture/encode thread shared by every viewer of one monitor.
+
+    The thread publishes the newest JPEG into a single slot and wakes the
+    waiting viewers; each viewer only ever sees the latest frame, so slow
+    clients drop stale frames instead of queueing them. It only runs
+    while the monitor has viewers (see producer_for).
+
+    In async server mode (see use_event_loop) the loop is a coroutine and
+    each capture/encode step runs in a dedicated executor instead.
+    """
+
+    def __init__(self, monitor_index=1):
+        self.monitor_index = monitor_index
+        self.cond = threading.Condition()
+        self.seq = 0
+        self.viewers = {'mjpeg': 0, 'tiles': 0, 'video': 0, 'roi': 0}
+
+        # Image stream variants (width, height, quality, codec) with at
+        # least one viewer, and the latest image of each; every variant is
+        # encoded once per frame however many viewers share it.
+        self.variants = {}
+        self.frames = {}
+
+        # H.264 streams by (width, height): viewer counts, the encoders
+        # (only touched by the capture loop) and their GOP caches.
+        # video_flush is set while the last encoded frame still sits in
+        # the muxers (see H264Encoder.flush).
+        self.video_sizes = {}
+        self.video_encoders = {}
+        self.video_caches = {}
+        self.video_flush = False
+        # Subscriptions per page id (None for clients that send none);
+        # see ViewerPresence.
+        self.pages = {}
+        # Subscriptions whose frames must include the cursor; the others
+        # draw it themselves from the cursor feed (see CursorFeed).
+        self.cursor_viewers = 0
+        self.runner = None
+        self.loop = None
+        self.executor = None
+        self.listeners = []
+        self.signal = None
+        self.pool = None
+        self.skipped = 0
+        self.force_publish = False
+        self.timer = capture.StageTimer(histogram=STAGE_SECONDS)
+
+        # Buffers reused frame to frame so the steady-state loop barely
+        # allocates: raw captures, rendered frames (two, so the previous
+        # one survives for the tile diff), the change check's copy of the
+        # last capture and resize scratch.
+        self.raw_ring = frame_pipeline.FrameRing(2)
+        self.render_ring = frame_pipeline.FrameRing(2)
+        self.tile_ring = frame_pipeline.FrameRing(2)
+        self.frame_shape = None
+        self.screen_generation = None
+        self.origin = (0, 0)
+        self.screen_size = None
+        # (screen size, zoom, draw cursor) to render the current capture
+        # with: the monitor and zoom_factor, or a zoomed-in region at
+        # zoom 1.0. view_meta is what the frames show, for the cursor feed.
+        self.view = None
+        self.view_meta = None
+        self.changes = frame_pipeline.ChangeDetector()
+        self.variant_scratch = {}
+        self.tile_diff = None
+        self.tile_changed = None
+        self.parts = {}
+
+        # Tile delta state: per-tile version (seq it last changed in) and
+        # the JPEG of each tile as of that version.
+        self.tile_versions = None
+        self.tile_data = {}
+        self.tile_rects = []
+        self.tile_frame_size = None
+        self.last_rendered = None
+
+        # ROI mode: the latest background and patches (with the seq each
+        # was published in), and the next ones waiting for their frame
+        # to be published.
+        self.roi_background = None
+        self.roi_background_seq = 0
+        self.roi_patches = None
+        self.roi_seq = 0
+        self.roi_next = None
+        self.roi_scratch = {}
+
+    def subscribe(self, kind='mjpeg', variant=None, page=None, cursor=True):
+        if page and presence.is_hidden(page):
+            # Pages only open streams while visible, so this one is back
+            # even if its visibility report was lost
+            presence.set_visible(page, True)
+        with self.cond:
+            self.viewers[kind] += 1
+            self.cursor_viewers += bool(cursor)
+            self.pages[page] = self.pages.get(page, 0) + 1
+            if kind == 'video':
+                self.video_sizes[variant] = self.video_sizes.get(variant, 0) + 1
+            elif variant is not None:
+                self.variants[variant] = self.variants.get(variant, 0) + 1
+            if kind == 'tiles' and self.viewers[kind] == 1:
+                # Tiles are only kept current while someone watches them
+                self.tile_versions = None
+            if kind == 'roi' and self.viewers[kind] == 1:
+                # So is the ROI background
+                self.roi_background = self.roi_patches = None
+            if self.runner is None:
+                self.runner = self._start()
+            else:
+                # Force the next grab to publish so a new viewer isn't
+                # left waiting for the desktop to change; wake the loop
+                # if it is lingering.
+                self.force_publish = True
+                self.cond.notify_all()
+
+    def use_event_loop(self, loop, executor):
+        """Run the capture loop as a coroutine on ``loop`` from now on."""
+        self.loop = loop
+        self.executor = executor
+
+    def add_listener(self, callback):
+        """Call ``callback()`` from the producer after every published frame."""
+        self.listeners.append(callback)
+
+    def _start(self):
+        if self.loop is not None:
+            return asyncio.run_coroutine_threadsafe(self._run_async(), self.loop)
+        thread = threading.Thread(target=self._run, daemon=True)
+        thread.start()
+        return thread
+
+    def unsubscribe(self, kind='mjpeg', variant=None, page=None, cursor=True):
+        with self.cond:
+            self.viewers[kind] = max(0, self.viewers[kind] - 1)
+            self.cursor_viewers = max(0, self.cursor_viewers - bool(cursor))
+            count = self.pages.get(page, 0) - 1
+            if count > 0:
+                self.pages[page] = count
+            else:
+                self.pages.pop(page, None)
+            if kind == 'video':
+                count = self.video_sizes.get(variant, 0) - 1
+                if count > 0:
+                    self.video_sizes[variant] = count
+                else:
+                    self.video_sizes.pop(variant, None)
+                    self.video_caches.pop(variant, None)
+            elif variant is not None:
+                self._release_variant(variant)
+
+    def switch_variant(self, old, new):
+        with self.cond:
+            self._release_variant(old)
+            self.variants[new] = self.variants.get(new, 0) + 1
+            if new not in self.frames:
+                self.force_publish = True
+
+    def _release_variant(self, variant):
+        count = self.variants.get(variant, 0) - 1
+        if count > 0:
+            self.variants[variant] = count
+        else:
+            # Its last frame stays until the next publish (or the end of
+            # the linger), ready for a viewer that comes straight back.
+            self.variants.pop(variant, None)
+
+    def wait_for_frame(self, last_seq, timeout=1.0):
+        """Block until a frame newer than ``last_seq`` exists, return its seq."""
+        with self.cond:
+            self.cond.wait_for(lambda: self.seq != last_seq, timeout)
+            return self.seq
+
+    def part_for(self, variant):
+        """The latest frame of ``variant`` as a multipart chunk, built once per frame."""
+        with self.cond:
+            part = self.parts.get(variant)
+            if part is None:
+                jpeg = self.frames.get(variant)
+                if jpeg is None:
+                    return None
+                part = self.parts[variant] = b''.join((PART_HEADERS[variant[3]], jpeg, b'\r\n'))
+            return part
+
+    def video_chunks(self, size, position):
+        """MP4 data for an H.264 viewer after ``position`` (see GopCache.read)."""
+        with self.cond:
+            cache = self.video_caches.get(size)
+            if cache is None:
+                return [], position
+            return cache.read(position)
+
+    def tile_snapshot(self, known):
+        """Collect the tiles a viewer hasn't seen yet.
+
+        ``known`` is the viewer's array of tile versions (None at first);
+        returns (seq, frame_size, [(rect, jpeg), ...], new_known).
+        """
+        with self.cond:
+            if self.tile_versions is None:
+                return self.seq, None, [], known
+            if known is None or known.shape != self.tile_versions.shape:
+                known = np.zeros_like(self.tile_versions)
+            cols = self.tile_versions.shape[1]
+            tiles = [(self.tile_rects[r * cols + c], self.tile_data[(r, c)])
+                     for r, c in np.argwhere(self.tile_versions > known)]
+            return self.seq, self.tile_frame_size, tiles, self.tile_versions.copy()
+
+    def roi_snapshot(self, background_seq):
+        """``(seq, roi_seq, message or None, background_seq)`` for a viewer
+        whose background is from ``background_seq``; the message carries
+        the background only if that one is out of date."""
+        with self.cond:
+            if self.roi_patches is None or self.roi_background is None:
+                return self.seq, self.roi_seq, None, background_seq
+            if background_seq != self.roi_background_seq:
+                parts, kind = [self.roi_background] + self.roi_patches, MSG_ROI
+            else:
+                parts, kind = self.roi_patches, MSG_ROI_PATCHES
+            full_w, full_h = self.roi_background[0][2:]
+            return (self.seq, self.roi_seq, pack_tiles(full_w, full_h, parts, kind),
+                    self.roi_background_seq)
+
+    def _update_tiles(self, frame):
+        h, w = frame.shape[:2]
+        row_starts = np.arange(0, h, TILE_SIZE)
+        col_starts = np.arange(0, w, TILE_SIZE)
+        prev = self.last_rendered
+        versions = self.tile_versions
+        if versions is None or prev is None or prev.shape != frame.shape:
+            dirty = np.ones((len(row_starts), len(col_starts)), dtype=bool)
+            self.tile_rects = [(int(x), int(y), min(TILE_SIZE, w - int(x)), min(TILE_SIZE, h - int(y)))
+                               for y in row_starts for x in col_starts]
+            versions = np.zeros(dirty.shape, dtype=np.int64)
+        else:
+            if self.tile_diff is None or self.tile_diff.shape != frame.shape:
+                self.tile_diff = np.empty(frame.shape, dtype=bool)
+                self.tile_changed = np.empty(frame.shape[:2], dtype=bool)
+            np.not_equal(frame, prev, out=self.tile_diff)
+            changed = np.any(self.tile_diff, axis=2, out=self.tile_changed)
+            dirty = np.logical_or.reduceat(
+                np.logical_or.reduceat(changed, row_starts, axis=0), col_starts, axis=1)
+
+        cols = len(col_starts)
+        encoded = {}
+        for r, c in np.argwhere(dirty):
+            x, y, tw, th = self.tile_rects[r * cols + c]
+            _, buffer = cv2.imencode('.jpg', frame[y:y + th, x:x + tw], [cv2.IMWRITE_JPEG_QUALITY, TILE_QUALITY])
+            encoded[(int(r), int(c))] = buffer.tobytes()
+        return versions, dirty, encoded
+
+    def _process(self, img, pos_x, pos_y, clicked, changed=None, new=True):
+        """Render and encode a capture, inline or on the encode pool.
+
+        ``new`` is False when only the cursor moved.
+        """
+        if self.viewers['roi']:
+            stage = time.perf_counter()
+            background = new or self.roi_background is None
+            self.roi_next = self._encode_roi(img, pos_x, pos_y, clicked, changed, background)
+            self.timer.record('roi', stage)
+        with self.cond:
+            variants = list(self.variants)
+        if WEBP_ENCODE_WORKERS and any(codec == 'webp' for *_, codec in variants):
+            self._start_pool(WEBP_ENCODE_WORKERS)
+        out_size = self._render_size(variants)
+        if not variants and not self.viewers['tiles'] and not self.viewers['video']:
+            # Only ROI viewers: nothing to render
+            self._publish(None, {}, time.perf_counter())
+            return
+        if self.pool is None:
+            frame = self._render(img, pos_x, pos_y, clicked, out_size)
+            started = time.perf_counter()
+            self._publish(frame, frame_pipeline.encode_variants(frame, variants, self.variant_scratch),
+                          started)
+            return
+        stage = time.perf_counter()
+        want_frame = self.viewers['tiles'] > 0 or self.viewers['video'] > 0
+        screen_size, zoom, draw = self.view
+        ready = self.pool.submit(img, (pos_x, pos_y), screen_size, zoom, clicked,
+                                 variants, want_frame=want_frame, out_size=out_size, cursor=draw)
+        self.timer.record('submit', stage)
+        for job in ready:
+            self._publish(*job)
+
+    def _render_size(self, variants):
+        """Render at the largest rendition anyone watches; smaller variants
+        are scaled down from it. Tiles always use STREAM_SIZE."""
+        with self.cond:
+            sizes = [(w, h) for w, h, *_ in variants] + list(self.video_sizes)
+        if self.viewers['tiles'] or not sizes:
+            sizes.append(frame_pipeline.STREAM_SIZE)
+        return max(sizes, key=lambda size: size[1])
+
+    def _encode_roi(self, img, pos_x, pos_y, clicked, changed, background):
+        full_h, full_w = img.shape[:2]
+        screen_w, screen_h = self.screen_size
+        scale_x, scale_y = full_w / screen_w, full_h / screen_h
+        cursor = (int(pos_x * scale_x), int(pos_y * scale_y))
+        rects = [frame_pipeline.roi_rect(full_w, full_h, cursor, ROI_PATCH_SIZE)]
+        click_x, click_y = last_click_pos[0] - self.origin[0], last_click_pos[1] - self.origin[1]
+        if (time.time() - last_click_time < ROI_CLICK_SECONDS
+                and 0 <= click_x < screen_w and 0 <= click_y < screen_h):
+            click = (click_x * scale_x, click_y * scale_y)
+            rects.append(frame_pipeline.roi_rect(full_w, full_h, click, ROI_CLICK_SIZE))
+        # ``changed`` is the bounding box of the pixels that changed
+        if changed is not None and changed[2] * changed[3] <= ROI_MAX_CHANGED_AREA:
+            rects.append(changed)
+        budget = ROI_BYTE_BUDGET
+        if not background:
+            # A viewer with a stale background gets the cached one in the
+            # same message as these patches, so they share the budget
+            budget -= len(self.roi_background[1])
+        return frame_pipeline.encode_roi(
+            img, frame_pipeline.merge_rects(rects), frame_pipeline.STREAM_SIZE,
+            ROI_BG_QUALITY, ROI_PATCH_QUALITY, cursor, clicked, self.roi_scratch,
+            background=background, budget=budget, min_quality=ROI_MIN_QUALITY)
+
+    def _encode_video(self, frame):
+        """Feed ``frame`` to the H.264 encoder of every watched size.
+
+        Returns {size: (init_segment, [(fragment, is_keyframe), ...])}.
+        Encoders are created on first use and closed once their last
+        viewer leaves.
+        """
+        with self.cond:
+            sizes = list(self.video_sizes)
+        for size in [s for s in self.video_encoders if s not in sizes]:
+            self.video_encoders.pop(size).close()
+        out = {}
+        for size in sizes:
+            encoder = self.video_encoders.get(size)
+            if encoder is None:
+                encoder = self.video_encoders[size] = video_codec.H264Encoder(
+                    *size, crf=VIDEO_CRF, keyframe_interval=VIDEO_KEYFRAME_INTERVAL,
+                    preset=VIDEO_PRESET, max_kbps=BANDWIDTH_CAP_KBPS)
+            scaled = frame
+            if frame.shape[:2] != (size[1], size[0]):
+                scaled = cv2.resize(frame, size, dst=self.variant_scratch.get(size),
+                                    interpolation=cv2.INTER_AREA)
+                self.variant_scratch[size] = scaled
+            fragments = encoder.encode(scaled)
+            out[size] = (encoder.init, fragments)
+        return out
+
+    def _tile_frame(self, frame):
+        out_w, out_h = frame_pipeline.STREAM_SIZE
+        if frame.shape[:2] == (out_h, out_w):
+            return frame
+        dst = self.tile_ring.slot((out_h, out_w, frame.shape[2]))
+        return cv2.resize(frame, (out_w, out_h), dst=dst, interpolation=cv2.INTER_AREA)
+
+    def _publish(self, frame, frames, started):
+        # With the encode pool ``started`` is the submit time, so the
+        # 'encode' stage also covers queueing and re-sequencing.
+        if frames:
+            started = self.timer.record('encode', started)
+            FRAMES_ENCODED.inc(len(frames))
+        tiles = video = None
+        # ``frame`` is None for pool jobs submitted while nobody watched
+        # tiles or video
+        if frame is not None:
+            if self.video_sizes or self.video_encoders:
+                video = self._encode_video(frame)
+                self.video_flush = bool(self.video_encoders)
+                started = self.timer.record('video', started)
+            if self.viewers['tiles']:
+                frame = self._tile_frame(frame)
+                tiles = self._update_tiles(frame)
+                self.timer.record('tiles', started)
+            self.last_rendered = frame
+        with self.cond:
+            self.seq += 1
+            self.frames = {v: b for v, b in frames.items() if v in self.variants}
+            self.parts = {}
+            if tiles is not None:
+                versions, dirty, encoded = tiles
+                versions[dirty] = self.seq
+                self.tile_versions = versions
+                self.tile_frame_size = (frame.shape[1], frame.shape[0])
+                self.tile_data.update(encoded)
+            if self.roi_next is not None:
+                background, self.roi_patches = self.roi_next
+                self.roi_next = None
+                self.roi_seq = self.seq
+                if background is not None:
+                    self.roi_background, self.roi_background_seq = background, self.seq
+            self._cache_video(video or {})
+            self.cond.notify_all()
+        for callback in self.listeners:
+            callback()
+
+    def _cache_video(self, video):
+        for size, (init, fragments) in video.items():
+            if size not in self.video_sizes:
+                continue
+            cache = self.video_caches.setdefault(size, video_codec.GopCache())
+            cache.init = init
+            for fragment, keyframe in fragments:
+                cache.add(fragment, keyframe)
+
+    def _flush_video(self):
+        """Push the last frame out of the H.264 muxers when no new one follows."""
+        self.video_flush = False
+        video = {size: (encoder.init, encoder.flush()) for size, encoder in self.video_encoders.items()}
+        with self.cond:
+            self.seq += 1
+            self._cache_video(video)
+            self.cond.notify_all()
+        for callback in self.listeners:
+            callback()
+
+    def wake(self):
+        """Re-check presence: resume a paused loop (or let a running one
+        notice it should pause), restart one that lingered out while its
+        viewers were hidden."""
+        with self.cond:
+            if self.runner is None:
+                if self._watched():
+                    self.runner = self._start()
+            else:
+                self.cond.notify_all()
+
+    def _watched(self):
+        """Anyone to capture for: a viewer whose page isn't hidden."""
+        return any(page is None or not presence.is_hidden(page) for page in self.pages)
+
+    def _should_stop(self):
+        """Sleep while nobody is watching; True once that outlasts CAPTURE_LINGER."""
+        with self.cond:
+            deadline = None
+            while not self._watched():
+                if deadline is None:
+                    deadline = time.time() + CAPTURE_LINGER
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.runner = None
+                    self.frames, self.parts = {}, {}
+                    return True
+                self.cond.wait(remaining)
+            if deadline is not None:
+                # Back from a pause: the last frame may be long stale
+                self.force_publish = True
+            return False
+
+    def _open_backend(self):
+        backend = capture.open_backend(CAPTURE_BACKEND)
+        backend.open()
+        try:
+            self._reset_geometry(backend)
+        except Exception:
+            backend.close()
+            raise
+        if ENCODE_WORKERS:
+            self._start_pool(ENCODE_WORKERS)
+        return backend
+
+    def _start_pool(self, workers):
+        if self.pool is None:
+            largest = max(RENDITIONS.values(), key=lambda size: size[1])
+            # Slots sized for the whole monitor take every zoomed region too
+            self.pool = frame_pipeline.EncodePool(workers, out_size=largest,
+                                                  max_size=self.screen_size)
+
+    def _reset_geometry(self, backend):
+        """Start over from the backend's current monitor layout."""
+        monitors = backend.monitors()
+        screen.set_layout(monitors)
+        if self.monitor_index >= len(monitors):
+            raise ValueError(f"no monitor {self.monitor_index} (found {len(monitors) - 1})")
+        self.monitor = monitors[self.monitor_index]
+        # The cursor is in virtual desktop coordinates; the overlay and
+        # zoom want them relative to this monitor.
+        self.origin = (self.monitor['left'], self.monitor['top'])
+        self.screen_size = (self.monitor['width'], self.monitor['height'])
+        self.screen_generation = screen.generation
+        self.frame_shape = None
+        self.changes.reset()
+        self.last_overlay = None
+
+    def _backend_failed(self, error):
+        print(f"⚠️  Capture backend {CAPTURE_BACKEND!r} failed on monitor {self.monitor_index}: {error}")
+        with self.cond:
+            self.runner = None
+
+    def _run(self):
+        try:
+            backend = self._open_backend()
+        except Exception as e:
+            self._backend_failed(e)
+            return
+        try:
+            while not self._should_stop():
+                started = time.time()
+                self._step(backend)
+                time.sleep(max(0.0, FRAME_INTERVAL - (time.time() - started)))
+        finally:
+            self._close_backend(backend)
+
+    async def _run_async(self):
+        loop = asyncio.get_running_loop()
+        try:
+            backend = await loop.run_in_executor(self.executor, self._open_backend)
+        except Exception as e:
+            self._backend_failed(e)
+            return
+        try:
+            while not await loop.run_in_executor(self.executor, self._should_stop):
+                started = time.time()
+                await loop.run_in_executor(self.executor, self._step, backend)
+                await asyncio.sleep(max(0.0, FRAME_INTERVAL - (time.time() - started)))
+        finally:
+            await loop.run_in_executor(self.executor, self._close_backend, backend)
+
+    def _close_backend(self, backend):
+        backend.close()
+        for encoder in self.video_encoders.values():
+            encoder.close()
+        self.video_encoders.clear()
+        if self.pool is not None:
+            # Nobody is watching any more; just free the slots. The
+            # worker processes stay up for the next viewer.
+            try:
+                self.pool.drain()
+            except Exception:
+                pass
+
+    def _step(self, backend):
+        """Grab one frame and publish it unless nothing changed."""
+        try:
+            if screen.generation != self.screen_generation:
+                # Resolution changed: reconnect so the backend re-reads
+                # the monitor geometry
+                backend.close()
+                backend.open()
+                self._reset_geometry(backend)
+            pos_x, pos_y = screen.position()
+            pos_x, pos_y = pos_x - self.origin[0], pos_y - self.origin[1]
+            clicked = time.time() - last_click_time < 0.3
+            zoom = zoom_factor
+            draw = self.cursor_viewers > 0
+            if draw or zoom > 1.0 or self.viewers['roi']:
+                overlay = (pos_x, pos_y, clicked, zoom, draw)
+            else:
+                # Nothing in the frames follows the cursor: pointing
+                # around an idle desktop publishes nothing
+                overlay = (zoom, draw)
+            region = self._capture_region(pos_x, pos_y, zoom)
+
+            stage = time.perf_counter()
+            img = backend.grab(region, out=self._grab_buffer(backend, region))
+            if region is self.monitor:
+                if img.shape != self.frame_shape and self.monitor_index == 1:
+                    screen.set_capture_size(img.shape[1], img.shape[0])
+                self.view = (self.screen_size, zoom, draw)
+                shown = frame_pipeline.zoom_region(self.monitor, (pos_x, pos_y), zoom)
+            else:
+                # Rendered as if the region were the whole screen
+                pos_x -= region['left'] - self.origin[0]
+                pos_y -= region['top'] - self.origin[1]
+                self.view = ((region['width'], region['height']), 1.0, draw)
+                shown = region
+            self.view_meta = {'rect': [shown['left'], shown['top'], shown['width'], shown['height']],
+                              'drawn': draw}
+            self.frame_shape = img.shape
+            stage = self.timer.record('grab', stage)
+
+            # Skip the encode entirely when neither the desktop nor
+            # the cursor overlay changed since the last frame.
+            new, changed = self.changes.update(img, box=self.viewers['roi'] > 0)
+            stage = self.timer.record('compare', stage)
+            if not new and overlay == self.last_overlay and not self.force_publish:
+                self.skipped += 1
+                FRAMES_SKIPPED.inc()
+                if self.video_flush:
+                    self._flush_video()
+            else:
+                self.force_publish = False
+                self._process(img, pos_x, pos_y, clicked, changed, new)
+                self.last_overlay = overlay
+            if self.pool is not None:
+                # Publish pool results that finished while the desktop idled
+                for job in self.pool.ready():
+                    self._publish(*job)
+        except Exception as e:
+            print(f"⚠️  Capture error: {e}")
+            self.changes.reset()
+            # The render ring may have moved past the last published frame
+            self.last_rendered = None
+
+    def _capture_region(self, pos_x, pos_y, zoom):
+        """What to grab: only the zoomed rectangle around the cursor, or
+        the whole monitor when not zoomed or when ROI viewers need it."""
+        if zoom <= 1.0 or self.viewers['roi']:
+            return self.monitor
+        return frame_pipeline.zoom_region(self.monitor, (pos_x, pos_y), zoom)
+
+    def _grab_buffer(self, backend, region):
+        """Where the next capture should be written, None to let the backend allocate."""
+        if self.frame_shape is None:
+            return None
+        shape = (region['height'], region['width'], self.frame_shape[2])
+        if self.pool is not None:
+            # Straight into the encode pool's shared memory
+            return self.pool.slot(shape)
+        if backend.zero_copy:
+            return None
+        return self.raw_ring.slot(shape)
+
+    def _render(self, img, pos_x, pos_y, clicked, out_size):
+        # BGR or BGRA depending on the capture backend; both flow through
+        # resize and JPEG encode unchanged.
+        out_w, out_h = out_size
+        dst = self.render_ring.slot((out_h, out_w, img.shape[2]))
+        screen_size, zoom, draw = self.view
+        return frame_pipeline.render_frame(img, (pos_x, pos_y), screen_size,
+                                           zoom, clicked, out_size=out_size,
+                                           timer=self.timer, dst=dst, cursor=draw)
+
+
+# --- MONITORS ---
+# One FrameProducer per monitor, created the first time someone asks for
+# that monitor; each captures only its own monitor and only while it has
+# viewers, so watching one monitor costs nothing for the others.
+producers = {}
+producers_lock = threading.Lock()
+capture_loop = None
+
+def producer_for(index=1):
+    with producers_lock:
+        producer = producers.get(index)
+        if producer is None:
+            producer = producers[index] = FrameProducer(index)
+            if capture_loop is not None:
+                _use_capture_loop(producer)
+        return producer
+
+def _use_capture_loop(producer):
+    producer.use_event_loop(capture_loop, ThreadPoolExecutor(
+        1, thread_name_prefix=f'capture-{producer.monitor_index}'))
+    producer.signal = AsyncFrameSignal(capture_loop, producer)
+
+def run_producers_on(loop):
+    """Async server mode: every producer, present and future, runs on ``loop``."""
+    global capture_loop
+    with producers_lock:
+        capture_loop = loop
+        for producer in producers.values():
+            _use_capture_loop(producer)
+
+def monitor_arg(args):
+    """?monitor=N (1 = primary); unknown monitors fall back to the primary."""
+    index = args.get('monitor', 1, type=int)
+    return index if 1 <= index < len(screen.monitors()) else 1
+
+def monitor_list():
+    return [dict(rect, index=i, primary=i == 1) for i, rect in enumerate(screen.monitors()) if i]
+
+# --- VIEWER PRESENCE ---
+class ViewerPresence:
+    """Which pages are hidden (background tab, locked phone).
+
+    Each page sends a random ``page`` id with its streams and reports
+    ``visibility`` changes as input events. A producer whose viewers all
+    belong to hidden pages pauses as if nobody were connected. Pages
+    that never report stay visible, and opening a stream marks a page
+    visible again; entries of pages that disappeared while hidden are
+    dropped after SESSION_LIFETIME.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hidden = {}
+
+    def is_hidden(self, page):
+        return page in self.hidden
+
+    def set_visible(self, page, visible):
+        if not page:
+            return
+        now = time.time()
+        with self.lock:
+            self.hidden = {p: t for p, t in self.hidden.items()
+                           if now - t < SESSION_LIFETIME.total_seconds()}
+            if visible:
+                self.hidden.pop(page, None)
+            else:
+                self.hidden[page] = now
+        with producers_lock:
+            running = list(producers.values())
+        for producer in running:
+            producer.wake()
+
+presence = ViewerPresence()
+
+# --- CURSOR FEED ---
+def server_cursor(args):
+    """False for ?cursor=client: the page draws the cursor over the stream."""
+    return args.get('cursor') != 'client'
+
+class CursorFeed:
+    """Cursor metadata pushed down one /input connection.
+
+    Pages that stream with ?cursor=client draw the cursor themselves, so
+    pointing around costs a few bytes instead of a re-encoded frame.
+    Each message is one JSON line: the cursor in virtual desktop
+    coordinates, whether a click is fresh, and per running monitor the
+    rectangle its frames show (the zoom area) and whether the frames
+    already include the cursor. Sent only on change, at most CURSOR_HZ
+    times a second, and not at all while no monitor is being captured.
+    """
+
+    def __init__(self):
+        self.last = None
+        self.sent_at = 0.0
+
+    def active(self):
+        with producers_lock:
+            return any(p.runner is not None for p in producers.values())
+
+    def poll_interval(self):
+        """How long the connection may wait for input before calling next_message."""
+        return 1.0 / CURSOR_HZ if self.active() else INPUT_REORDER_WINDOW
+
+    def next_message(self):
+        now = time.time()
+        if now - self.sent_at < 1.0 / CURSOR_HZ:
+            return None
+        with producers_lock:
+            views = {str(i): p.view_meta for i, p in producers.items()
+                     if p.runner is not None and p.view_meta is not None}
+        if not views:
+            return None
+        x, y = screen.position()
+        state = {'x': x, 'y': y, 'click': now - last_click_time < 0.3, 'views': views}
+        if state == self.last:
+            return None
+        self.last, self.sent_at = state, now
+        return json.dumps({'cursor': state})
+
+# --- ADAPTIVE STREAM CONTROL ---
+def available_renditions(monitor=1):
+    """Renditions that don't upscale the monitor, smallest first."""
+    names = sorted(RENDITIONS, key=lambda n: RENDITIONS[n][1])
+    height = screen.monitors()[monitor]['height']
+    fitting = [n for n in names if RENDITIONS[n][1] <= height]
+    return fitting or names[:1]
+
+def pick_rendition(args):
+    """?rendition=NAME, else the smallest rendition at least as wide as the
+    viewer's image box (?vw=&vh= in CSS pixels, times ?dpr)."""
+    names = available_renditions(monitor_arg(args))
+    name = args.get('rendition', 'auto')
+    if name in names:
+        return name
+    vw = args.get('vw', 0, type=float)
+    vh = args.get('vh', 0, type=float)
+    if vw <= 0 or vh <= 0:
+        return DEFAULT_RENDITION if DEFAULT_RENDITION in names else names[-1]
+    # The 16:9 stream is letterboxed into the box, so only the shown width counts
+    shown = min(vw, vh * 16 / 9) * max(1.0, min(args.get('dpr', 1.0, type=float), 3.0))
+    for name in names:
+        if RENDITIONS[name][0] >= shown:
+            return name
+    return names[-1]
+
+def quality_ladder(rendition):
+    width, height = RENDITIONS[rendition]
+    ladder = [(width, height, 60), (width, height, 30)]
+    ladder += [(w, h, 25) for w, h in sorted(RENDITIONS.values(), reverse=True) if h < height]
+    ladder += [rung for rung in LADDER_TAIL if rung[1] < ladder[-1][1]]
+    return ladder
+
+class AdaptiveController:
+    """Per-viewer rate control driven by socket backpressure.
+
+    The time each frame write blocks is the signal: when it exceeds the
+    latency target the viewer steps down the quality ladder (then FPS),
+    and after a calm second with plenty of headroom it steps back up.
+    """
+
+    def __init__(self, rendition=DEFAULT_RENDITION, ceiling=1, latency_ms=TARGET_LATENCY_MS,
+                 kbps=0, max_fps=MAX_FPS):
+        self.rendition = rendition
+        self.ladder = quality_ladder(rendition)
+        self.ceiling = min(ceiling, len(self.ladder) - 1)
+        self.level = self.ceiling
+        self.target = latency_ms / 1000.0
+        self.kbps = kbps
+        self.max_fps = max_fps
+        self.fps = max_fps
+        self.write_time = None
+        self.frame_bytes = None
+        self.calm = 0
+        self.cooldown = 0
+
+    @classmethod
+    def from_args(cls, args):
+        ceiling = QUALITY_PRESETS.get(args.get('quality', 'medium'), QUALITY_PRESETS['medium'])
+        return cls(rendition=pick_rendition(args), ceiling=ceiling,
+                   latency_ms=args.get('latency', TARGET_LATENCY_MS, type=float),
+                   kbps=args.get('kbps', BANDWIDTH_CAP_KBPS, type=float),
+                   max_fps=max(MIN_FPS, min(args.get('fps', MAX_FPS, type=float), MAX_FPS)))
+
+    @property
+    def variant(self):
+        return self.ladder[self.level]
+
+    def frame_interval(self):
+        interval = 1.0 / self.fps
+        if self.kbps and self.frame_bytes:
+            interval = max(interval, self.frame_bytes * 8 / (self.kbps * 1000))
+        return interval
+
+    def record(self, nbytes, write_time):
+        if self.write_time is None:
+            self.write_time, self.frame_bytes = write_time, float(nbytes)
+        else:
+            self.write_time += 0.2 * (write_time - self.write_time)
+            self.frame_bytes += 0.2 * (nbytes - self.frame_bytes)
+
+        if self.cooldown:
+            self.cooldown -= 1
+            return
+        over_cap = self.kbps and self.frame_bytes * 8 * MIN_FPS > self.kbps * 1000
+        if self.write_time > self.target or over_cap:
+            self.calm = 0
+            self.cooldown = 5
+            if self.level < len(self.ladder) - 1:
+                self.level += 1
+            else:
+                self.fps = max(MIN_FPS, self.fps * 0.75)
+        elif self.write_time < self.target / 2:
+            self.calm += 1
+            if self.calm >= self.fps:
+                self.calm = 0
+                self.cooldown = 5
+                if self.fps < self.max_fps:
+                    self.fps = min(self.max_fps, self.fps * 1.25)
+                elif self.level > self.ceiling:
+                    self.level -= 1
+
+    def stats(self):
+        width, height, quality = self.variant
+        return {
+            'rendition': self.rendition,
+            'width': width,
+            'height': height,
+            'quality': quality,
+            'fps': round(self.fps, 1),
+            'target_latency_ms': round(self.target * 1000),
+            'bandwidth_cap_kbps': self.kbps,
+            'write_ms': round((self.write_time or 0) * 1000, 1),
+            'frame_bytes': round(self.frame_bytes or 0),
+        }
+
+class MjpegStream:
+    """One /video_feed viewer: its controller, pacing and last frame sent.
+
+    ``codec`` is the image format of the multipart stream, 'jpeg' (MJPEG)
+    or 'webp'. Without ``cursor`` the frames leave the cursor out (if no
+    other viewer needs it) and the page draws it from the cursor feed.
+    """
+
+    def __init__(self, controller, codec='jpeg', producer=None, page=None, cursor=True):
+        self.controller = controller
+        self.codec = codec
+        self.producer = producer or producer_for(1)
+        self.page = page
+        self.cursor = cursor
+        self.label = 'mjpeg' if codec == 'jpeg' else codec
+        self.last_seq = 0
+        self.last_part = None
+        self.last_sent = 0
+        self.next_due = 0
+        self.frames_sent = 0
+        self.bytes_sent = 0
+
+    @property
+    def variant(self):
+        return self.controller.variant + (self.codec,)
+
+    def open(self):
+        self.producer.subscribe('mjpeg', self.variant, self.page, self.cursor)
+        with video_streams_lock:
+            video_streams[id(self)] = self
+
+    def close(self):
+        self.producer.unsubscribe('mjpeg', self.variant, self.page, self.cursor)
+        with video_streams_lock:
+            video_streams.pop(id(self), None)
+
+    def pacing_delay(self):
+        return self.next_due - time.time()
+
+    def next_part(self):
+        """The next multipart chunk to send, or None if there's nothing new."""
+        seq = self.producer.seq
+        part = self.producer.part_for(self.variant)
+        if part is None:
+            self.last_seq = seq
+            return None
+        if seq == self.last_seq or part is self.last_part:
+            # Idle desktop (or a seq that only flushed H.264): resend the
+            # last frame now and then so proxies and browsers keep the
+            # stream open.
+            if time.time() - self.last_sent < KEEPALIVE_INTERVAL:
+                self.last_seq = seq
+                return None
+        elif self.last_seq:
+            FRAMES_DROPPED.inc(max(0, seq - self.last_seq - 1))
+        self.last_seq, self.last_part = seq, part
+        return part
+
+    def sent(self, nbytes, write_time):
+        self.last_sent = time.time()
+        self.frames_sent += 1
+        self.bytes_sent += nbytes
+        FRAMES_SENT.inc(stream=self.label)
+        BYTES_SENT.inc(nbytes, stream=self.label)
+        STAGE_SECONDS.observe(write_time, stage='write')
+        variant = self.variant
+        self.controller.record(nbytes, write_time)
+        if self.variant != variant:
+            self.producer.switch_variant(variant, self.variant)
+        self.next_due = self.last_sent - write_time + self.controller.frame_interval()
+
+    def stats(self):
+        stats = self.controller.stats()
+        stats.update(codec=self.codec, monitor=self.producer.monitor_index,
+                     frames_sent=self.frames_sent, bytes_sent=self.bytes_sent)
+        return stats
+
+    @classmethod
+    def from_args(cls, args):
+        codec = args.get('codec', 'jpeg')
+        return cls(AdaptiveController.from_args(args),
+                   codec if codec in frame_pipeline.IMAGE_CODECS else 'jpeg',
+                   producer_for(monitor_arg(args)), args.get('page'), server_cursor(args))
+
+class VideoStream:
+    """One /video_mp4 viewer: its H.264 size and place in the fragment stream."""
+
+    def __init__(self, size, producer=None, page=None, cursor=True):
+        self.size = size
+        self.producer = producer or producer_for(1)
+        self.page = page
+        self.cursor = cursor
+        self.position = None
+        self.last_seq = 0
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(RENDITIONS[pick_rendition(args)], producer_for(monitor_arg(args)),
+                   args.get('page'), server_cursor(args))
+
+    def open(self):
+        self.producer.subscribe('video', self.size, self.page, self.cursor)
+
+    def close(self):
+        self.producer.unsubscribe('video', self.size, self.page, self.cursor)
+
+    def next_chunk(self):
+        """The MP4 data this viewer hasn't had yet, or None."""
+        self.last_seq = self.producer.seq
+        chunks, self.position = self.producer.video_chunks(self.size, self.position)
+        return b''.join(chunks) if chunks else None
+
+    def sent(self, nbytes, write_time):
+        FRAMES_SENT.inc(stream='h264')
+        BYTES_SENT.inc(nbytes, stream='h264')
+        STAGE_SECONDS.observe(write_time, stage='write')
+
+video_streams = {}
+video_streams_lock = threading.Lock()
+
+def viewer_counts():
+    """Viewers of each kind, summed over all monitors."""
+    counts = {}
+    with producers_lock:
+        for producer in producers.values():
+            for kind, n in producer.viewers.items():
+                counts[(kind,)] = counts.get((kind,), 0) + n
+    return counts
+
+METRICS.gauge('remote_viewers', 'Connected stream viewers.', ('kind',), callback=viewer_counts)
+
 @app.route('/video_feed')
 def video_feed():
     if not session.get('auth'):
         return "Unauthorized", 401
-        
+
+    stream = MjpegStream.from_args(request.args)
+
     def gen():
-        global zoom_factor, last_click_time
-        with mss.mss() as sct:
-            monitor = sct.monitors[1]
+        stream.open()
+        try:
             while True:
-                img = np.array(sct.grab(monitor))
-                raw_frame = cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
+                delay = stream.pacing_delay()
+                if delay > 0:
+                    time.sleep(delay)
+                stream.producer.wait_for_frame(stream.last_seq, KEEPALIVE_INTERVAL)
+                part = stream.next_part()
+                if part is None:
+                    continue
+                started = time.time()
+                yield part
+                stream.sent(len(part), time.time() - started)
+        finally:
+            stream.close()
+    return Response(gen(), mimetype='multipart/x-mixed-replace; boundary=frame')
 
-                # Original capture size (might differ from SCREEN_W/SCREEN_H on high‑DPI displays)
-                full_h, full_w = raw_frame.shape[:2]
+@app.route('/video_mp4')
+def video_mp4():
+    if not session.get('auth'):
+        return "Unauthorized", 401
+    if video_codec.av is None:
+        return "H.264 streaming needs PyAV (pip install av)", 503
 
-                # Current mouse position (screen coordinates)
-                pos_x, pos_y = pyautogui.position()
+    stream = VideoStream.from_args(request.args)
 
-                if zoom_factor > 1.0:
-                    # ---- ZOOM REGION ----
-                    new_h = int(full_h / zoom_factor)
-                    new_w = int(full_w / zoom_factor)
+    def gen():
+        stream.open()
+        try:
+            while True:
+                stream.producer.wait_for_frame(stream.last_seq, KEEPALIVE_INTERVAL)
+                chunk = stream.next_chunk()
+                if chunk is None:
+                    continue
+                started = time.time()
+                yield chunk
+                stream.sent(len(chunk), time.time() - started)
+        finally:
+            stream.close()
+    return Response(gen(), mimetype='video/mp4', headers={'Cache-Control': 'no-cache'})
 
-                    # Centered on the *screen* mouse position
-                    center_x = int(pos_x * full_w / SCREEN_W)
-                    center_y = int(pos_y * full_h / SCREEN_H)
+@app.route('/metrics')
+def metrics_endpoint():
+    # Scrapers can't log in, so they may present METRICS_TOKEN instead
+    auth = request.headers.get('Authorization', '')
+    token = auth[len('Bearer '):] if auth.startswith('Bearer ') else None
+    if not session.get('auth') and not (METRICS_TOKEN and token == METRICS_TOKEN):
+        return "Unauthorized", 401
+    return Response(METRICS.render(), mimetype='text/plain; version=0.0.4')
 
-                    x1 = max(0, center_x - new_w // 2)
-                    y1 = max(0, center_y - new_h // 2)
-                    x2 = min(full_w, x1 + new_w)
-                    y2 = min(full_h, y1 + new_h)
+@app.route('/stream_stats')
+def stream_stats():
+    if not session.get('auth'):
+        return jsonify({'streams': []}), 401
+    with video_streams_lock:
+        streams = [s.stats() for s in video_streams.values()]
+    with producers_lock:
+        running = dict(producers)
+    return jsonify({
+        'streams': streams,
+        'skipped_frames': sum(p.skipped for p in running.values()),
+        'capture': {'backend': CAPTURE_BACKEND, 'encode_workers': ENCODE_WORKERS,
+                    'webp_encode_workers': WEBP_ENCODE_WORKERS,
+                    'monitors': {str(i): {'skipped_frames': p.skipped,
+                                          'stages_ms': p.timer.snapshot()}
+                                 for i, p in running.items()}},
+        'screen': {'size': list(screen.size()), 'dpi_scale': round(screen.dpi_scale(), 3)},
+    })
 
-                    # Edge correction
-                    if x2 - x1 < new_w:
-                        x1 = max(0, x2 - new_w)
-                    if y2 - y1 < new_h:
-                        y1 = max(0, y2 - new_h)
+def pack_tiles(width, height, tiles, kind=MSG_TILES):
+    """Binary tile update: header (type, frame w/h, count) then per tile
+    x, y, w, h, length and the JPEG bytes, all little-endian. The JPEG is
+    drawn scaled to its w x h rectangle (ROI backgrounds are smaller)."""
+    parts = [struct.pack('<BHHH', kind, width, height, len(tiles))]
+    for (x, y, w, h), data in tiles:
+        parts.append(struct.pack('<HHHHI', x, y, w, h, len(data)))
+        parts.append(data)
+    return b''.join(parts)
 
-                    frame_crop = raw_frame[y1:y2, x1:x2]
+class TileStream:
+    """One /tiles viewer: the tile versions it has already drawn."""
 
-                    # ------- CURSOR OVERLAY CALCULATION -------
-                    region_x_screen = x1 * SCREEN_W / full_w
-                    region_y_screen = y1 * SCREEN_H / full_h
-                    region_w_screen = (x2 - x1) * SCREEN_W / full_w
-                    region_h_screen = (y2 - y1) * SCREEN_H / full_h
+    kind = 'tiles'
 
-                    rel_x = (pos_x - region_x_screen) / region_w_screen
-                    rel_y = (pos_y - region_y_screen) / region_h_screen
+    def __init__(self, producer=None, page=None, cursor=True):
+        self.producer = producer or producer_for(1)
+        self.page = page
+        self.cursor = cursor
+        self.known = None
+        self.last_seq = 0
 
-                    # Clamp just in case
-                    rel_x = max(0, min(rel_x, 1))
-                    rel_y = max(0, min(rel_y, 1))
+    @staticmethod
+    def from_args(args):
+        """?mode=roi for an ROI viewer, else tiles; ?monitor=N, ?page= and
+        ?cursor= as for /video_feed."""
+        if args.get('mode') == 'roi':
+            return RoiStream(producer_for(monitor_arg(args)), args.get('page'))
+        return TileStream(producer_for(monitor_arg(args)), args.get('page'), server_cursor(args))
 
-                    cx = int(rel_x * 960)
-                    cy = int(rel_y * 540)
+    def open(self):
+        self.producer.subscribe(self.kind, page=self.page, cursor=self.cursor)
 
-                    # Resize for streaming
-                    frame = cv2.resize(frame_crop, (960, 540))
-                else:
-                    # No zoom – direct scaling
-                    cx = int(pos_x * 960 / SCREEN_W)
-                    cy = int(pos_y * 540 / SCREEN_H)
-                    frame = cv2.resize(raw_frame, (960, 540))
-
-                # ----- DRAW CURSOR -----
-                if 0 <= cx < 960 and 0 <= cy < 540:
-                    cv2.circle(frame, (cx, cy), 12, (74, 158, 255), 2)
-                    cv2.circle(frame, (cx, cy), 2, (74, 158, 255), -1)
-
-                    # Click visual feedback
-                    if time.time() - last_click_time < 0.3:
-                        cv2.circle(frame, (cx, cy), 30, (0, 255, 0), 3)
-
-                _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 30])
-                yield (b'--frame\r\nContent-Type: image/jpeg\r\n\r\n' + buffer.tobytes() + b'\r\n')
-                time.sleep(0.04)  # ~25 FPS
-    return Response(gen(), mimetype='multipart/x-mixed-replace; boundary=frame')
+    def close(self):
+        self.producer.unsubscribe(self.kind, page=self.page, cursor=self.cursor)
+
+    def next_message(self):
+        """The next binary tile update, or None if there's nothing new."""
+        if self.producer.seq == self.last_seq:
+            return None
+        self.last_seq, size, tiles, self.known = self.producer.tile_snapshot(self.known)
+        return pack_tiles(size[0], size[1], tiles) if tiles else None
+
+    def sent(self, nbytes, write_time):
+        STAGE_SECONDS.observe(write_time, stage='write')
+        FRAMES_SENT.inc(stream=self.kind)
+        BYTES_SENT.inc(nbytes, stream=self.kind)
+
+class RoiStream(TileStream):
+    """A /tiles?mode=roi viewer: every update is a complete composition.
+
+    The ROI patches carry their own cursor, so the rendered frames need
+    none on this viewer's account.
+    """
+
+    kind = 'roi'
+
+    def __init__(self, producer=None, page=None):
+        super().__init__(producer, page, cursor=False)
+        self.roi_seq = 0
+        self.background_seq = None
+
+    def next_message(self):
+        if self.producer.seq == self.last_seq:
+            return None
+        self.last_seq, roi_seq, message, background_seq = self.producer.roi_snapshot(self.background_seq)
+        if roi_seq == self.roi_seq:
+            # A seq without a new ROI update (an H.264 flush)
+            return None
+        self.roi_seq, self.background_seq = roi_seq, background_seq
+        return message
+
+if sock:
+    @sock.route('/tiles')
+    def tiles_feed(ws):
+        if not session.get('auth'):
+            ws.close(reason=1008, message="Unauthorized")
+            return
+        stream = TileStream.from_args(request.args)
+        stream.open()
+        try:
+            while True:
+                stream.producer.wait_for_frame(stream.last_seq, KEEPALIVE_INTERVAL)
+                message = stream.next_message()
+                if message is None:
+                    continue
+                started = time.perf_counter()
+                ws.send(message)
+                stream.sent(len(message), time.perf_counter() - started)
+        except ConnectionClosed:
+            pass
+        finally:
+            stream.close()
+
+# --- STATE STREAM ---
+class StateHub:
+    """UI state pushed to every open page over /state_stream.
+
+    ``publish`` stores the keys whose value changed and bumps ``seq``;
+    a subscriber asks for ``changes_since`` its last seq, so however many
+    changes land between two of its events it gets one event with the
+    latest value of each changed key. Every tab reads the same state, so
+    zoom, volume and held keys stay in sync across tabs.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.seq = 0
+        self.state = {}
+        self.changed = {}
+        self.listeners = []
+
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+    def publish(self, **changes):
+        with self.cond:
+            seq = self.seq
+            for key, value in changes.items():
+                if key not in self.state or self.state[key] != value:
+                    self.seq += 1
+                    self.state[key] = value
+                    self.changed[key] = self.seq
+            if self.seq == seq:
+                return
+            self.cond.notify_all()
+        for callback in self.listeners:
+            callback()
+
+    def changes_since(self, seq):
+        """``(current seq, {key: value})`` of the keys changed after ``seq`` (all for 0)."""
+        with self.cond:
+            return self.seq, {k: self.state[k] for k, at in self.changed.items() if at > seq}
+
+    def wait(self, seq, timeout):
+        with self.cond:
+            self.cond.wait_for(lambda: self.seq != seq, timeout)
+            return self.seq
+
+state_hub = StateHub()
+
+def server_metrics():
+    with producers_lock:
+        running = [p for p in producers.values() if p.runner is not None]
+    return {
+        'viewers': sum(viewer_counts().values()),
+        'capturing': sorted(p.monitor_index for p in running),
+        'skipped_frames': sum(p.skipped for p in running),
+    }
+
+def refresh_server_state():
+    """Pick up what changes without an action: volume set on the host, server metrics."""
+    volume_service.refresh()
+    state_hub.publish(metrics=server_metrics())
+
+def sse_event(data, event=None):
+    head = f"event: {event}\n" if event else ""
+    return f"{head}data: {json.dumps(data)}\n\n"
+
+def health_event():
+    return sse_event({'t': int(time.time() * 1000)}, 'health')
+
+state_hub.publish(zoom=zoom_factor, held_keys=[])
+
+@app.route('/state_stream')
+def state_stream():
+    if not session.get('auth'):
+        return "Unauthorized", 401
+
+    def gen():
+        seq = 0
+        yield "retry: 2000\n\n"
+        while True:
+            seq, changes = state_hub.changes_since(seq)
+            if changes:
+                yield sse_event(changes)
+            time.sleep(STATE_MIN_INTERVAL)
+            if state_hub.wait(seq, KEEPALIVE_INTERVAL) == seq:
+                refresh_server_state()
+                yield health_event()
+    return Response(gen(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# --- VOLUME ---
+class VolumeService:
+    """Owns the audio backend on one worker thread.
+
+    ``set`` only records the requested level; the worker applies the
+    latest one at most once per VOLUME_TICK, so dragging the slider
+    costs a few OS calls instead of one per input event. ``level`` is
+    the cached current volume (None without a backend), re-read after
+    every change and on ``refresh`` (at most once per KEEPALIVE_INTERVAL,
+    however many state streams ask), and published on the state stream.
+    ``available`` says whether a backend opened, once ``opened`` is set.
+    """
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.cond = threading.Condition()
+        self.target = None
+        self.stale = True
+        self.level = None
+        self.read_at = 0.0
+        self.available = None  # None until the backend has been opened
+        self.opened = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """Open the backend on the worker thread (called once at startup)."""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def set(self, level):
+        with self.cond:
+            self.target = min(1.0, max(0.0, float(level)))
+            self.cond.notify()
+
+    def refresh(self):
+        """Re-read the level, e.g. in case it was changed on the host,
+        unless it was read within the last KEEPALIVE_INTERVAL."""
+        with self.cond:
+            if time.monotonic() - self.read_at < KEEPALIVE_INTERVAL:
+                return
+            self.stale = True
+            self.cond.notify()
+
+    def _run(self):
+        try:
+            backend = audio.open_backend(self.spec)
+        except ValueError as e:
+            print(f"⚠️  {e}")
+            backend = None
+        self.available = backend is not None
+        self.opened.set()
+        if backend is None:
+            return
+        try:
+            while True:
+                with self.cond:
+                    self.cond.wait_for(lambda: self.target is not None or self.stale)
+                    target, self.target, self.stale = self.target, None, False
+                    self.read_at = time.monotonic()
+                try:
+                    if target is not None:
+                        backend.set(target)
+                    self.level = backend.get()
+                except Exception as e:
+                    print(f"⚠️  Volume control failed: {e}")
+                state_hub.publish(volume=self.level)
+                if target is not None:
+                    time.sleep(VOLUME_TICK)
+        finally:
+            backend.close()
+
+volume_service = VolumeService(AUDIO_BACKEND)
+
+# --- TEXT INJECTION ---
+class TextInjector:
+    """Types text on its own thread so other input never waits behind it.
+
+    ``put`` queues a text and returns its job id; jobs run in order and
+    ``cancel`` drops the queued ones and stops the running one at its
+    next chunk. Keyboard and discrete pointer actions that arrive while
+    text is pending are queued here too (``defer``), so an Enter still
+    lands after the text and a tap on another field cannot move the
+    focus under it. Continuous motion (move_joy, joy_vel) is not held
+    back.
+    Progress is published on the state stream as
+    ``typing = {id, done, total, state}``.
+    """
+
+    ORDERED_ACTIONS = {"enter", "key", "key_down", "key_up",
+                       "click", "middle_click", "right_click",
+                       "drag_start", "drag_end", "right_drag_start", "right_drag_end",
+                       "move_abs", "scroll_up", "scroll_down"}
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.jobs = []
+        self.thread = None
+        self.running = False
+        self.next_id = 1
+        self.cancelled = 0  # Jobs up to this id are dropped
+
+    def put(self, text):
+        if not text:
+            return None
+        with self.cond:
+            job = self.next_id
+            self.next_id += 1
+            self.jobs.append((job, text))
+            self._start()
+        return job
+
+    def defer(self, t, args):
+        """Queue an ORDERED_ACTIONS action behind pending text; False if nothing is pending."""
+        with self.cond:
+            if not self.running and not self.jobs:
+                return False
+            self.jobs.append((None, (t, args)))
+            self._start()
+        return True
+
+    def cancel(self):
+        with self.cond:
+            self.cancelled = self.next_id - 1
+            # Keep deferred actions: dropping a key_up or drag_end would
+            # leave the key or button held
+            self.jobs = [entry for entry in self.jobs if entry[0] is None]
+
+    def _start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        self.cond.notify()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                self.running = False
+                self.cond.wait_for(lambda: self.jobs)
+                job, text = self.jobs.pop(0)
+                self.running = True
+            if job is None:
+                try:
+                    dispatch_action(*text)
+                except Exception as e:
+                    print(f"⚠️  Action {text[0]} failed: {e}")
+                continue
+            self._report(job, 0, text, 'typing')
+            try:
+                done = self._inject(job, text)
+            except Exception as e:
+                print(f"⚠️  Typing failed: {e}")
+                self._report(job, 0, text, 'failed')
+                continue
+            self._report(job, done, text, 'done' if done == len(text) else 'cancelled')
+
+    def _inject(self, job, text):
+        """Returns how many characters went in."""
+        if pyperclip and (len(text) >= TYPE_PASTE_MIN or not text.isascii()):
+            if self._paste(text):
+                return len(text)
+        done = 0
+        while done < len(text) and job > self.cancelled:
+            chunk = text[done:done + TYPE_CHUNK]
+            pyautogui.write(chunk, interval=TYPE_INTERVAL)
+            done += len(chunk)
+            self._report(job, done, text, 'typing')
+        return done
+
+    def _paste(self, text):
+        try:
+            previous = pyperclip.paste()
+            pyperclip.copy(text)
+        except pyperclip.PyperclipException:
+            return False
+        pyautogui.hotkey('command' if sys.platform == 'darwin' else 'ctrl', 'v')
+        # The target app reads the clipboard when it handles the keys
+        time.sleep(0.1)
+        try:
+            pyperclip.copy(previous)
+        except pyperclip.PyperclipException:
+            pass
+        return True
+
+    def _report(self, job, done, text, state):
+        state_hub.publish(typing={'id': job, 'done': done, 'total': len(text), 'state': state})
+
+text_injector = TextInjector()
 
 # --- ACTION HANDLER ---
 def mark_click():
-    global last_click_time
+    global last_click_time, last_click_pos
     last_click_time = time.time()
+    last_click_pos = screen.position()
+
+def move_abs(args):
+    """Move to ?nx=&ny= (fractions of ?monitor=N, the primary screen by
+    default, so the page needs no screen size), or to absolute ?x=&y=
+    virtual desktop pixels."""
+    if 'nx' in args:
+        screen.move_to_normalized(args.get('nx', 0), args.get('ny', 0),
+                                  int(args.get('monitor') or 0))
+    else:
+        screen.move_to(float(args.get('x', 0)), float(args.get('y', 0)))
 
 def zoom_in():
     global zoom_factor
     zoom_factor = min(zoom_factor + 0.25, 4.0)
+    state_hub.publish(zoom=zoom_factor)
 
 def zoom_out():
     global zoom_factor
     zoom_factor = max(zoom_factor - 0.25, 1.0)
+    state_hub.publish(zoom=zoom_factor)
 
 def zoom_reset():
     global zoom_factor
     zoom_factor = 1.0
+    state_hub.publish(zoom=zoom_factor)
 
 def set_volume(val):
-    if audio_available and volume:
-        try:
-            volume.SetMasterVolumeLevelScalar(float(val) / 100, None)
-        except:
-            pass
+    volume_service.set(float(val) / 100)
 
 def scroll_up():
     pyautogui.scroll(3)
@@ -1409,12 +3727,14 @@ def key_down(key):
     if key:
         held_keys.add(key)
         pyautogui.keyDown(key)
+        state_hub.publish(held_keys=sorted(held_keys))
 
 def key_up(key):
     global held_keys
     if key:
         held_keys.discard(key)
         pyautogui.keyUp(key)
+        state_hub.publish(held_keys=sorted(held_keys))
 
 def right_drag_start():
     pyautogui.mouseDown(button='right')
@@ -1422,6 +3742,65 @@ def right_drag_start():
 def right_drag_end():
     pyautogui.mouseUp(button='right')
 
+class CursorMover:
+    """Integrates the joystick velocity into cursor motion at JOY_TICK_HZ.
+
+    ``joy_vel`` sets the velocity in the same units move_joy steps use per
+    40 ms tick; the loop carries sub-pixel remainders so slow pushes still
+    move smoothly. The velocity drops to zero on ``joy_stop`` or when no
+    update arrived for JOY_VELOCITY_TIMEOUT seconds.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.vx = 0.0
+        self.vy = 0.0
+        self.updated = 0
+        self.thread = None
+
+    def set_velocity(self, x, y):
+        with self.cond:
+            self.vx = float(x) * JOY_SPEED_SCALE
+            self.vy = float(y) * JOY_SPEED_SCALE
+            self.updated = time.time()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            self.cond.notify()
+
+    def stop(self):
+        with self.cond:
+            self.vx = self.vy = 0.0
+
+    def _run(self):
+        rest_x = rest_y = 0.0
+        last = time.perf_counter()
+        while True:
+            with self.cond:
+                if time.time() - self.updated > JOY_VELOCITY_TIMEOUT:
+                    self.vx = self.vy = 0.0
+                if not (self.vx or self.vy):
+                    self.cond.wait_for(lambda: self.vx or self.vy)
+                    rest_x = rest_y = 0.0
+                    last = time.perf_counter()
+                vx, vy = self.vx, self.vy
+            now = time.perf_counter()
+            dt = min(now - last, 0.05)
+            last = now
+            rest_x += vx * dt
+            rest_y += vy * dt
+            dx, dy = int(rest_x), int(rest_y)
+            rest_x -= dx
+            rest_y -= dy
+            if dx or dy:
+                try:
+                    screen.move_by(dx, dy)
+                except Exception as e:
+                    print(f"⚠️  Cursor move failed: {e}")
+            time.sleep(1.0 / JOY_TICK_HZ)
+
+cursor_mover = CursorMover()
+
 # Mapping from action name → callable
 ACTIONS = {
     "click": lambda: (pyautogui.click(), mark_click()),
@@ -1431,18 +3810,19 @@ ACTIONS = {
     "drag_end": lambda: pyautogui.mouseUp(),
     "right_drag_start": right_drag_start,
     "right_drag_end": right_drag_end,
-    "type": lambda val: pyautogui.write(val, interval=0.01),
+    "type": text_injector.put,
+    "type_cancel": text_injector.cancel,
     "enter": press_enter,
-    "move_joy": lambda x, y: pyautogui.moveRel(float(x)*2, float(y)*2, _pause=False),
-    "move_abs": lambda x, y: (
-        setattr(__import__('__main__'), 'zoom_center_x', float(x)),
-        setattr(__import__('__main__'), 'zoom_center_y', float(y)),
-        pyautogui.moveTo(float(x), float(y), _pause=False)
-    ),
+    "move_joy": lambda x, y: screen.move_by(int(float(x)*2), int(float(y)*2)),
+    "joy_vel": lambda x, y: cursor_mover.set_velocity(x, y),
+    "joy_stop": lambda: cursor_mover.stop(),
+    "move_abs": move_abs,
     "zoom_in": zoom_in,
     "zoom_out": zoom_out,
     "zoom_reset": zoom_reset,
     "volume": set_volume,
+    "visibility": lambda page, visible: presence.set_visible(
+        page, str(visible).lower() not in ('false', '0', '')),
     "scroll_up": scroll_up,
     "scroll_down": scroll_down,
     "key": press_key,
@@ -1450,33 +3830,438 @@ ACTIONS = {
     "key_up": key_up,
 }
 
+def dispatch_action(t, args):
+    """Run one ACTIONS entry; ``args`` is request.args or an input event dict."""
+    if t not in ACTIONS:
+        return False
+    started = time.perf_counter()
+    try:
+        _run_action(t, args)
+    finally:
+        ACTIONS_HANDLED.inc(action=t)
+        ACTION_SECONDS.observe(time.perf_counter() - started, action=t)
+    return True
+
+def _run_action(t, args):
+    if t == "type":
+        ACTIONS[t](args.get('val', ''))
+    elif t in ["move_joy", "joy_vel"]:
+        ACTIONS[t](args.get('x', 0), args.get('y', 0))
+    elif t == "move_abs":
+        ACTIONS[t](args)
+    elif t == "volume":
+        ACTIONS[t](args.get('val', 50))
+    elif t == "visibility":
+        ACTIONS[t](args.get('page'), args.get('visible', True))
+    elif t in ["key", "key_down", "key_up"]:
+        ACTIONS[t](args.get('key', ''))
+    else:
+        ACTIONS[t]()
+
+class InputQueue:
+    """Applies input on one worker thread, coalescing cursor motion.
+
+    Each time the worker wakes it takes everything queued: runs of
+    move_joy collapse into one summed relative move and runs of move_abs
+    into the last target, while every other event (clicks, keys, ...)
+    keeps its exact position in the order. Runs of joy_vel and volume
+    keep the newest value.
+    """
+
+    COALESCE = {"move_joy", "move_abs", "joy_vel", "volume"}
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.events = []
+        self.thread = None
+
+    def put(self, t, args):
+        if t not in ACTIONS:
+            return
+        with self.cond:
+            self.events.append((t, args))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            self.cond.notify()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.events)
+                batch, self.events = self.events, []
+            for t, args in self.coalesce(batch):
+                if t in TextInjector.ORDERED_ACTIONS and text_injector.defer(t, args):
+                    continue
+                try:
+                    dispatch_action(t, args)
+                except Exception as e:
+                    print(f"⚠️  Action {t} failed: {e}")
+
+    @classmethod
+    def coalesce(cls, batch):
+        merged = []
+        for t, args in batch:
+            if merged and t in cls.COALESCE and merged[-1][0] == t:
+                prev = merged[-1][1]
+                if t == "move_joy":
+                    args = {'x': float(prev.get('x', 0)) + float(args.get('x', 0)),
+                            'y': float(prev.get('y', 0)) + float(args.get('y', 0))}
+                merged[-1] = (t, args)
+            else:
+                merged.append((t, args))
+        return merged
+
+input_queue = InputQueue()
+
 @app.route('/action')
 def action():
-    if not session.get('auth'):
+    if not action_authorized():
         return "Unauthorized", 401
-    t = request.args.get('type')
-    if t in ACTIONS:
-        if t == "type":
-            ACTIONS[t](request.args.get('val', ''))
-        elif t in ["move_joy", "move_abs"]:
-            ACTIONS[t](request.args.get('x', 0), request.args.get('y', 0))
-        elif t == "volume":
-            ACTIONS[t](request.args.get('val', 50))
-        elif t in ["key", "key_down", "key_up"]:
-            ACTIONS[t](request.args.get('key', ''))
-        else:
-            ACTIONS[t]()
+    input_queue.put(request.args.get('type'), request.args.to_dict())
     return "OK"
 
+# --- INPUT CHANNEL ---
+class InputChannel:
+    """Ordered event stream from one page over the /input WebSocket.
+
+    Messages are JSON lines, one event per line:
+    ``{"seq": 12, "t": <client ms>, "type": "move_joy", "x": 1.5, "y": 0}``.
+    Events are handed to the input queue strictly in ``seq`` order; an
+    early event waits in a small reorder buffer until the gap
+    fills or INPUT_REORDER_WINDOW expires.
+    """
+
+    def __init__(self):
+        self.next_seq = None
+        self.pending = {}
+        self.gap_since = None
+        self.last_t = None
+        self.applied = 0
+
+    def handle(self, message):
+        """Apply a batch of events, return the ack line to send back (or None)."""
+        for line in message.splitlines():
+            if not line.strip():
+                continue
+            try:
+                event = json.loads(line)
+                seq = int(event['seq'])
+            except (ValueError, KeyError, TypeError):
+                continue
+            if self.next_seq is None:
+                self.next_seq = seq
+            if seq >= self.next_seq:
+                self.pending[seq] = event
+        self._drain()
+        if self.next_seq is None:
+            return None
+        return json.dumps({'ack': self.next_seq - 1, 't': self.last_t})
+
+    def _drain(self):
+        while self.pending:
+            if self.next_seq not in self.pending:
+                # Give a missing event a moment to arrive, then skip it
+                now = time.time()
+                if self.gap_since is None:
+                    self.gap_since = now
+                if now - self.gap_since < INPUT_REORDER_WINDOW and len(self.pending) < 64:
+                    return
+                self.next_seq = min(self.pending)
+            self.gap_since = None
+            event = self.pending.pop(self.next_seq)
+            self.next_seq += 1
+            self.last_t = event.get('t')
+            input_queue.put(event.get('type'), event)
+            self.applied += 1
+
+if sock:
+    @sock.route('/input')
+    def input_channel(ws):
+        if not session.get('auth'):
+            ws.close(reason=1008, message="Unauthorized")
+            return
+        # Authenticated once; the grant ends with the session or on logout
+        grant = action_tokens.issue(session, None)
+        channel = InputChannel()
+        feed = CursorFeed() if request.args.get('cursor') else None
+        try:
+            while action_tokens.check(grant):
+                timeout = feed.poll_interval() if feed else INPUT_REORDER_WINDOW
+                message = ws.receive(timeout=timeout)
+                ack = channel.handle(message or '')
+                if ack and message:
+                    ws.send(ack)
+                update = feed and feed.next_message()
+                if update:
+                    ws.send(update)
+            ws.close(reason=1008, message="Session expired")
+        except ConnectionClosed:
+            pass
+        finally:
+            action_tokens.discard(grant)
+
+# --- ASYNC SERVER MODE ---
+# SERVER_MODE=async serves the app with uvicorn. Streams, input and pings
+# are coroutines here, so a viewer costs a task instead of a thread; every
+# other route falls through to the Flask app via asgiref's WSGI adapter.
+# The capture loop runs on the event loop with grabs and encodes in a
+# single-thread executor.
+class AsyncFrameSignal:
+    """Wakes every coroutine waiting for a frame with one callback per frame.
+
+    Works for anything with ``seq`` and ``add_listener``: a FrameProducer
+    or the StateHub.
+    """
+
+    def __init__(self, loop, producer):
+        self.loop = loop
+        self.producer = producer
+        self.future = loop.create_future()
+        producer.add_listener(self.notify)
+
+    def notify(self):
+        self.loop.call_soon_threadsafe(self._fire)
+
+    def _fire(self):
+        future, self.future = self.future, self.loop.create_future()
+        future.set_result(None)
+
+    async def wait_for_frame(self, last_seq, timeout):
+        if self.producer.seq == last_seq:
+            try:
+                await asyncio.wait_for(asyncio.shield(self.future), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.producer.seq
+
+def asgi_session(scope):
+    """Decode the Flask session cookie of an ASGI request ({} if missing or invalid)."""
+    cookies = {}
+    for name, value in scope.get('headers', []):
+        if name == b'cookie':
+            cookies.update(parse_cookie(value.decode('latin-1')))
+    value = cookies.get(app.config['SESSION_COOKIE_NAME'])
+    if not value:
+        return {}
+    serializer = app.session_interface.get_signing_serializer(app)
+    try:
+        return serializer.loads(value, max_age=int(app.permanent_session_lifetime.total_seconds()))
+    except BadSignature:
+        return {}
+
+def asgi_header(scope, name):
+    """The value of header ``name`` of an ASGI request, None if absent."""
+    name = name.lower().encode('latin-1')
+    for key, value in scope.get('headers', []):
+        if key == name:
+            return value.decode('latin-1')
+    return None
+
+def query_args(scope):
+    return MultiDict(parse_qsl(scope.get('query_string', b'').decode('latin-1')))
+
+async def send_text(send, status, body, content_type='text/plain; charset=utf-8'):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', content_type.encode())]})
+    await send({'type': 'http.response.body', 'body': body.encode()})
+
+async def wait_disconnect(receive, message_type):
+    while (await receive())['type'] != message_type:
+        pass
+
+async def async_video_feed(scope, receive, send):
+    if not asgi_session(scope).get('auth'):
+        return await send_text(send, 401, "Unauthorized")
+    stream = MjpegStream.from_args(query_args(scope))
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': [(b'content-type', b'multipart/x-mixed-replace; boundary=frame')]})
+    disconnected = asyncio.ensure_future(wait_disconnect(receive, 'http.disconnect'))
+    stream.open()
+    try:
+        while not disconnected.done():
+            delay = stream.pacing_delay()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await stream.producer.signal.wait_for_frame(stream.last_seq, KEEPALIVE_INTERVAL)
+            part = stream.next_part()
+            if part is None:
+                continue
+            started = time.time()
+            await send({'type': 'http.response.body', 'body': part, 'more_body': True})
+            stream.sent(len(part), time.time() - started)
+    finally:
+        disconnected.cancel()
+        stream.close()
+
+async def async_video_mp4(scope, receive, send):
+    if not asgi_session(scope).get('auth'):
+        return await send_text(send, 401, "Unauthorized")
+    if video_codec.av is None:
+        return await send_text(send, 503, "H.264 streaming needs PyAV (pip install av)")
+    stream = VideoStream.from_args(query_args(scope))
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': [(b'content-type', b'video/mp4'), (b'cache-control', b'no-cache')]})
+    disconnected = asyncio.ensure_future(wait_disconnect(receive, 'http.disconnect'))
+    stream.open()
+    try:
+        while not disconnected.done():
+            await stream.producer.signal.wait_for_frame(stream.last_seq, KEEPALIVE_INTERVAL)
+            chunk = stream.next_chunk()
+            if chunk is None:
+                continue
+            started = time.time()
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            stream.sent(len(chunk), time.time() - started)
+    finally:
+        disconnected.cancel()
+        stream.close()
+
+async def async_action(scope, receive, send):
+    args = query_args(scope)
+    if not (action_tokens.check(asgi_header(scope, ACTION_TOKEN_HEADER))
+            or asgi_session(scope).get('auth')):
+        return await send_text(send, 401, "Unauthorized")
+    input_queue.put(args.get('type'), args.to_dict())
+    await send_text(send, 200, "OK")
+
+async def async_ping(scope, receive, send):
+    if not (action_tokens.check(asgi_header(scope, ACTION_TOKEN_HEADER))
+            or asgi_session(scope).get('auth')):
+        return await send_text(send, 401, "Unauthorized")
+    await send_text(send, 200, "OK")
+
+async def async_input(scope, receive, send):
+    await receive()  # websocket.connect
+    session_data = asgi_session(scope)
+    if not session_data.get('auth'):
+        return await send({'type': 'websocket.close', 'code': 1008})
+    await send({'type': 'websocket.accept'})
+    grant = action_tokens.issue(session_data, None)
+    channel = InputChannel()
+    feed = CursorFeed() if query_args(scope).get('cursor') else None
+    try:
+        while action_tokens.check(grant):
+            timeout = feed.poll_interval() if feed else INPUT_REORDER_WINDOW
+            try:
+                message = await asyncio.wait_for(receive(), timeout)
+            except asyncio.TimeoutError:
+                message = None
+                channel.handle('')
+            if message is not None:
+                if message['type'] == 'websocket.disconnect':
+                    return
+                ack = channel.handle(message.get('text') or message.get('bytes') or '')
+                if ack:
+                    await send({'type': 'websocket.send', 'text': ack})
+            update = feed and feed.next_message()
+            if update:
+                await send({'type': 'websocket.send', 'text': update})
+        await send({'type': 'websocket.close', 'code': 1008})
+    finally:
+        action_tokens.discard(grant)
+
+async def async_tiles(scope, receive, send):
+    await receive()  # websocket.connect
+    if not asgi_session(scope).get('auth'):
+        return await send({'type': 'websocket.close', 'code': 1008})
+    await send({'type': 'websocket.accept'})
+    stream = TileStream.from_args(query_args(scope))
+    disconnected = asyncio.ensure_future(wait_disconnect(receive, 'websocket.disconnect'))
+    stream.open()
+    try:
+        while not disconnected.done():
+            await stream.producer.signal.wait_for_frame(stream.last_seq, KEEPALIVE_INTERVAL)
+            message = stream.next_message()
+            if message is None:
+                continue
+            started = time.perf_counter()
+            await send({'type': 'websocket.send', 'bytes': message})
+            stream.sent(len(message), time.perf_counter() - started)
+    finally:
+        disconnected.cancel()
+        stream.close()
+
+async def async_state_stream(scope, receive, send):
+    if not asgi_session(scope).get('auth'):
+        return await send_text(send, 401, "Unauthorized")
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache'),
+                            (b'x-accel-buffering', b'no')]})
+    disconnected = asyncio.ensure_future(wait_disconnect(receive, 'http.disconnect'))
+    seq = 0
+    body = "retry: 2000\n\n"
+    try:
+        while not disconnected.done():
+            seq, changes = state_hub.changes_since(seq)
+            if changes:
+                body += sse_event(changes)
+            if body:
+                await send({'type': 'http.response.body', 'body': body.encode(), 'more_body': True})
+                body = ""
+            await asyncio.sleep(STATE_MIN_INTERVAL)
+            if await state_signal.wait_for_frame(seq, KEEPALIVE_INTERVAL) == seq:
+                refresh_server_state()
+                body = health_event()
+    finally:
+        disconnected.cancel()
+
+ASYNC_ROUTES = {
+    ('http', '/video_feed'): async_video_feed,
+    ('http', '/video_mp4'): async_video_mp4,
+    ('http', '/action'): async_action,
+    ('http', '/ping'): async_ping,
+    ('http', '/state_stream'): async_state_stream,
+    ('websocket', '/input'): async_input,
+    ('websocket', '/tiles'): async_tiles,
+}
+
+state_signal = None
+
+async def asgi_lifespan(receive, send):
+    global state_signal
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            run_producers_on(asyncio.get_running_loop())
+            state_signal = AsyncFrameSignal(asyncio.get_running_loop(), state_hub)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def asgi_app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await asgi_lifespan(receive, send)
+    handler = ASYNC_ROUTES.get((scope['type'], scope['path']))
+    if handler is not None:
+        return await handler(scope, receive, send)
+    if scope['type'] == 'websocket':
+        return await send({'type': 'websocket.close', 'code': 1000})
+    await wsgi_fallback(scope, receive, send)
+
+wsgi_fallback = WsgiToAsgi(app) if uvicorn else None
+
 # --- MAIN ---
 if __name__ == '__main__':
+    PASSWORD_HASH = generate_password_hash(os.environ.get("REMOTE_PASS", "idk"))
+    volume_service.start()
     print("=" * 50)
     print("🖥️  Enhanced Remote Desktop Server")
     print("=" * 50)
     print(f"🌐 Access at: http://0.0.0.0:5000")
     print(f"🔒 Default password: secret")
-    print(f"📱 Screen size: {SCREEN_W}x{SCREEN_H}")
-    print(f"🔊 Audio control: {'Enabled' if audio_available else 'Disabled (install pycaw)'}")
+    width, height = screen.size()
+    print(f"📱 Screen size: {width}x{height}")
+    # Opening a backend takes a moment (pycaw, pactl); the banner waits
+    # for it briefly, and keeps going if the sound system is slow
+    volume_service.opened.wait(2.0)
+    if volume_service.available:
+        print(f"🔊 Audio control: {AUDIO_BACKEND} (AUDIO_BACKEND=auto|pycaw|pulse|mock|none)")
+    elif volume_service.available is None:
+        print(f"🔊 Audio control: {AUDIO_BACKEND}, still opening")
+    else:
+        print(f"🔇 Audio control unavailable: {AUDIO_BACKEND} (AUDIO_BACKEND=auto|pycaw|pulse|mock|none)")
     print("=" * 50)
     print("\n✨ NEW FEATURES:")
     print("   • Settings panel auto-closes keyboard")
@@ -1484,4 +4269,10 @@ if __name__ == '__main__':
     print("   • Right-click drag feature")
     print("   • Visual feedback for held keys (red highlight)")
     print("=" * 50)
-    app.run(host='0.0.0.0', port=5000, threaded=True, debug=False)
+    if SERVER_MODE == 'async':
+        if uvicorn is None:
+            sys.exit("SERVER_MODE=async needs: pip install uvicorn asgiref websockets")
+        print("⚡ Async server mode (uvicorn)")
+        uvicorn.run(asgi_app, host='0.0.0.0', port=5000, log_level='warning')
+    else:
+        app.run(host='0.0.0.0', port=5000, threaded=True, debug=False)
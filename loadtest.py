@@ -0,0 +1,162 @@
+"""Load test for a running server: many stream viewers plus high-rate input.
+
+Logs in, opens ``--viewers`` concurrent /video_feed streams and fires
+``--actions`` /action requests per second (zero-distance joystick moves,
+so the cursor stays put), then reports per-viewer frame rate, action
+latency and errors. Uses only the standard library:
+
+    SERVER_MODE=async python latest-stable-version.py
+    python loadtest.py --password ... --viewers 50 --actions 200 --duration 30
+"""
+import argparse
+import asyncio
+import math
+import sys
+import time
+from urllib.parse import urlencode, urlsplit
+
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+async def request(host, port, method, path, headers=(), body=b''):
+    """One HTTP/1.1 request on a fresh connection; returns (reader, writer, status, headers)."""
+    reader, writer = await asyncio.open_connection(host, port)
+    lines = [f"{method} {path} HTTP/1.1", f"Host: {host}:{port}", "Connection: close"]
+    lines += [f"{k}: {v}" for k, v in headers]
+    if body:
+        lines.append(f"Content-Length: {len(body)}")
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + body)
+    await writer.drain()
+    status_line = await reader.readline()
+    status = int(status_line.split()[1])
+    response_headers = []
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        response_headers.append((name.strip().lower(), value.strip()))
+    return reader, writer, status, response_headers
+
+
+async def login(host, port, password):
+    body = urlencode({'p': password}).encode()
+    _, writer, status, headers = await request(
+        host, port, 'POST', '/',
+        [('Content-Type', 'application/x-www-form-urlencoded')], body)
+    writer.close()
+    # A wrong password gets the login page again (200), without a cookie
+    if status == 302:
+        for name, value in headers:
+            if name == 'set-cookie':
+                return value.split(';', 1)[0]
+    raise SystemExit(f"Login failed (HTTP {status})")
+
+
+async def viewer(host, port, cookie, query, deadline, stats):
+    frames, gaps, last = 0, [], None
+    try:
+        reader, writer, status, _ = await request(
+            host, port, 'GET', '/video_feed' + query, [('Cookie', cookie)])
+        if status != 200:
+            stats['errors'] += 1
+            writer.close()
+            return
+        while time.monotonic() < deadline:
+            line = await asyncio.wait_for(reader.readline(), deadline - time.monotonic())
+            if not line:
+                stats['errors'] += 1
+                break
+            if line.startswith(b'--frame'):
+                now = time.monotonic()
+                if last is not None:
+                    gaps.append(now - last)
+                frames, last = frames + 1, now
+        writer.close()
+    except asyncio.TimeoutError:
+        pass
+    except OSError:
+        stats['errors'] += 1
+    stats['viewer_frames'].append(frames)
+    stats['frame_gaps'].extend(gaps)
+
+
+async def action(host, port, cookie, stats):
+    path = '/action?' + urlencode({'type': 'move_joy', 'x': 0, 'y': 0})
+    started = time.monotonic()
+    try:
+        _, writer, status, _ = await request(host, port, 'GET', path, [('Cookie', cookie)])
+        writer.close()
+    except OSError:
+        stats['errors'] += 1
+        return
+    if status != 200:
+        stats['errors'] += 1
+        return
+    stats['action_latency'].append(time.monotonic() - started)
+
+
+async def actions(host, port, cookie, rate, deadline, stats):
+    if rate <= 0:
+        return
+    pending = set()
+    interval = 1.0 / rate
+    next_at = time.monotonic()
+    while next_at < deadline:
+        pending.add(asyncio.ensure_future(action(host, port, cookie, stats)))
+        next_at += interval
+        await asyncio.sleep(max(0.0, next_at - time.monotonic()))
+    if pending:
+        await asyncio.wait(pending)
+
+
+async def run(args):
+    url = urlsplit(args.url)
+    host, port = url.hostname, url.port or 80
+    cookie = await login(host, port, args.password)
+    stats = {'errors': 0, 'viewer_frames': [], 'frame_gaps': [], 'action_latency': []}
+    query = '?' + urlencode({'quality': args.quality}) if args.quality else ''
+    deadline = time.monotonic() + args.duration
+    tasks = [viewer(host, port, cookie, query, deadline, stats) for _ in range(args.viewers)]
+    tasks.append(actions(host, port, cookie, args.actions, deadline, stats))
+    await asyncio.gather(*tasks)
+    return stats
+
+
+def report(stats, duration):
+    frames = stats['viewer_frames']
+    fps = [n / duration for n in frames]
+    latency = stats['action_latency']
+    print(f"viewers:  {len(frames)}, fps min {min(fps, default=0):.1f} "
+          f"avg {sum(fps) / max(1, len(fps)):.1f} max {max(fps, default=0):.1f}")
+    gap = percentile(stats['frame_gaps'], 99)
+    if gap is not None:
+        print(f"frames:   p99 gap between frames {gap * 1000:.0f} ms")
+    if latency:
+        print(f"actions:  {len(latency)} ok ({len(latency) / duration:.0f}/s), "
+              f"p50 {percentile(latency, 50) * 1000:.1f} ms  p99 {percentile(latency, 99) * 1000:.1f} ms")
+    print(f"errors:   {stats['errors']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--password', required=True)
+    parser.add_argument('--viewers', type=int, default=20)
+    parser.add_argument('--actions', type=float, default=100, help='action requests per second')
+    parser.add_argument('--duration', type=float, default=20, help='seconds')
+    parser.add_argument('--quality', help='stream quality preset (high, medium, low)')
+    args = parser.parse_args(argv)
+    stats = asyncio.run(run(args))
+    report(stats, args.duration)
+    return 1 if stats['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
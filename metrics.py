@@ -0,0 +1,153 @@
+"""Minimal in-process metrics with Prometheus text exposition.
+
+Counters, gauges and histograms are registered on a ``Registry`` and
+rendered by ``Registry.render()`` in the Prometheus text format (0.0.4),
+so ``/metrics`` can be scraped without pulling in prometheus_client.
+"""
+import bisect
+import threading
+
+# Seconds; fine at the low end where per-stage frame work lives.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    body = ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                    for k, v in pairs)
+    return '{' + body + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labels)
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, self._format(key), value) for key, value in self.values.items()]
+
+    def _format(self, key):
+        return _format_labels(self.labels, key)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self.lock:
+            return self.values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    """A gauge set directly or read from ``callback()`` at scrape time.
+
+    The callback returns either a number or a ``{label_value_tuple: number}``
+    dict for labelled gauges.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=(), callback=None):
+        super().__init__(name, help, labels)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def samples(self):
+        if self.callback is not None:
+            current = self.callback()
+            if not isinstance(current, dict):
+                current = {(): current}
+            with self.lock:
+                self.values = dict(current)
+        return super().samples()
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * len(self.buckets), 0, 0.0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                state[0][index] += 1
+            state[1] += 1
+            state[2] += value
+
+    def samples(self):
+        out = []
+        with self.lock:
+            items = [(key, list(state[0]), state[1], state[2]) for key, state in self.values.items()]
+        for key, counts, total, sum_ in items:
+            running = 0
+            for bound, count in zip(self.buckets, counts):
+                running += count
+                out.append((self.name + '_bucket',
+                            _format_labels(self.labels, key, [('le', _format_value(float(bound)))]),
+                            running))
+            out.append((self.name + '_bucket',
+                        _format_labels(self.labels, key, [('le', '+Inf')]), total))
+            out.append((self.name + '_sum', self._format(key), sum_))
+            out.append((self.name + '_count', self._format(key), total))
+        return out
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=(), callback=None):
+        return self.register(Gauge(name, help, labels, callback))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{labels} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,200 @@
+"""H.264 in fragmented MP4, for Media Source Extensions playback.
+
+Optional: needs PyAV (``pip install av``), which bundles FFmpeg and
+libx264. ``H264Encoder`` is tuned for latency rather than compression:
+x264's ``zerolatency`` tune (no B-frames, no lookahead) and one MP4
+fragment per frame, so the browser can show a frame as soon as it
+arrives. ``GopCache`` keeps the init segment plus every fragment since
+the last keyframe, so a viewer joining mid-stream can start decoding
+straight away.
+"""
+import collections
+import struct
+import time
+from fractions import Fraction
+
+try:
+    import av
+except ImportError:
+    av = None
+
+# H.264 levels by the largest frame they allow, in 16x16 macroblocks
+# (their macroblock rates cover these sizes at 25 FPS)
+LEVELS = [(1620, '3.0', 0x1E), (3600, '3.1', 0x1F), (8192, '4.0', 0x28), (22080, '5.0', 0x32)]
+
+MOVFLAGS = 'empty_moov+default_base_moof+frag_every_frame'
+TIME_BASE = Fraction(1, 1000)
+
+
+class _Sink:
+    """Write-only file object for the muxer; collects what it writes.
+
+    There is deliberately no ``seek``: the MP4 muxer then treats the
+    output as a pipe and never goes back to patch earlier boxes.
+    """
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+        return len(data)
+
+    def take(self):
+        data = bytes(self.data)
+        self.data.clear()
+        return data
+
+
+def level_for(width, height):
+    """``(name, level_idc)`` of the lowest level a ``width`` x ``height`` stream fits."""
+    blocks = -(-width // 16) * -(-height // 16)
+    for max_blocks, name, idc in LEVELS:
+        if blocks <= max_blocks:
+            return name, idc
+    return LEVELS[-1][1:]
+
+
+def mime_type(width, height):
+    """Codec string for MediaSource.isTypeSupported / addSourceBuffer: baseline
+    profile at a level that fits streams up to ``width`` x ``height``."""
+    return f'video/mp4; codecs="avc1.42E0{level_for(width, height)[1]:02X}"'
+
+
+def split_boxes(data):
+    """Split the complete top-level MP4 boxes off ``data``.
+
+    Returns ``([(type, box_bytes), ...], rest)``; ``rest`` is the start
+    of a box that hasn't been fully written yet.
+    """
+    boxes = []
+    pos = 0
+    while len(data) - pos >= 8:
+        size, kind = struct.unpack_from('>I4s', data, pos)
+        if size == 1:
+            if len(data) - pos < 16:
+                break
+            size = struct.unpack_from('>Q', data, pos + 8)[0]
+        if size < 8 or len(data) - pos < size:
+            break
+        boxes.append((kind, data[pos:pos + size]))
+        pos += size
+    return boxes, data[pos:]
+
+
+class H264Encoder:
+    """One x264 encoder plus fragmented MP4 muxer for a fixed frame size.
+
+    ``encode(image)`` takes BGR or BGRA frames of that size and returns
+    the finished ``(fragment, is_keyframe)`` pairs; ``init`` holds the
+    init segment (ftyp + moov) once the muxer has written it. Frames
+    are timestamped by wall clock, so skipping unchanged frames simply
+    shows the previous frame for longer.
+
+    The muxer only writes a frame's fragment once the next frame comes
+    in, so ``flush()`` re-encodes the last frame to push it out when no
+    new one is coming; the repeat (the same picture) waits in its place.
+    """
+
+    def __init__(self, width, height, crf=28, keyframe_interval=50, preset='veryfast',
+                 max_kbps=0):
+        if av is None:
+            raise RuntimeError("H.264 streaming needs PyAV: pip install av")
+        self.sink = _Sink()
+        self.container = av.open(self.sink, mode='w', format='mp4',
+                                 container_options={'movflags': MOVFLAGS})
+        self.stream = self.container.add_stream('libx264')
+        context = self.stream.codec_context
+        context.width = width
+        context.height = height
+        context.pix_fmt = 'yuv420p'
+        context.time_base = TIME_BASE
+        context.gop_size = keyframe_interval
+        options = {'preset': preset, 'tune': 'zerolatency', 'profile': 'baseline', 'crf': str(crf),
+                   'level': level_for(width, height)[0]}
+        if max_kbps:
+            # Cap bursts at the link rate with a half second VBV buffer
+            options.update(maxrate=f'{int(max_kbps)}k', bufsize=f'{int(max_kbps // 2)}k')
+        context.options = options
+        self.init = b''
+        self.pending = b''
+        self.moof = None
+        self.keyframes = collections.deque()
+        self.started = time.perf_counter()
+        self.pts = -1
+        self.last = None
+
+    def encode(self, image):
+        fmt = 'bgra' if image.shape[2] == 4 else 'bgr24'
+        return self._encode(av.VideoFrame.from_ndarray(image, format=fmt))
+
+    def flush(self):
+        """Encode the last frame again so its fragment is written."""
+        if self.last is None:
+            return []
+        return self._encode(self.last)
+
+    def _encode(self, frame):
+        self.last = frame
+        self.pts = max(self.pts + 1, int((time.perf_counter() - self.started) * 1000))
+        frame.pts = self.pts
+        frame.time_base = TIME_BASE
+        for packet in self.stream.encode(frame):
+            self.keyframes.append(packet.is_keyframe)
+            self.container.mux(packet)
+        return self._collect()
+
+    def _collect(self):
+        boxes, self.pending = split_boxes(self.pending + self.sink.take())
+        fragments = []
+        for kind, box in boxes:
+            if kind in (b'ftyp', b'moov'):
+                self.init += box
+            elif kind == b'moof':
+                self.moof = box
+            elif kind == b'mdat' and self.moof is not None:
+                keyframe = self.keyframes.popleft() if self.keyframes else False
+                fragments.append((self.moof + box, keyframe))
+                self.moof = None
+        return fragments
+
+    def close(self):
+        try:
+            self.container.close()
+        except Exception:
+            pass
+
+
+class GopCache:
+    """The init segment and the fragments since the last keyframe.
+
+    Positions count fragments since the stream started; ``read`` hands a
+    viewer everything after its position. A new viewer (position None)
+    gets the init segment and the whole cached GOP. A viewer that fell
+    further behind than the cache skips ahead to the last keyframe.
+    """
+
+    def __init__(self):
+        self.init = b''
+        self.fragments = []
+        self.first = 0
+
+    @property
+    def end(self):
+        return self.first + len(self.fragments)
+
+    def add(self, fragment, keyframe):
+        if keyframe:
+            self.first = self.end
+            self.fragments = []
+        self.fragments.append(fragment)
+
+    def read(self, position):
+        """Returns ``(chunks, new_position)``."""
+        if not self.init or not self.fragments:
+            return [], position
+        if position is None:
+            return [self.init] + self.fragments, self.end
+        if position < self.first:
+            return list(self.fragments), self.end
+        return self.fragments[position - self.first:], self.end